@@ -0,0 +1,225 @@
+'''
+Connect to the Mendeley sqlite database.
+
+Mendeley Desktop may have the database open during an export. Besides a
+plain connection, the database can be opened read-only, or copied into
+memory first, so that the export never takes write locks on or changes
+the library, and queries run on an in-memory copy.
+
+Mendeley's own indexes don't cover all the joins of the export, an
+in-memory copy can be given covering indexes for them.
+
+Connections are queries.Connection objs, with the schema of the database
+detected once connected.
+'''
+import os
+import time
+import sqlite3
+import queries
+try:
+    from urllib import pathname2url
+except ImportError:
+    from urllib.request import pathname2url
+
+# 'default': plain connection, as Mendeley does.
+# 'readonly': open read-only and immutable, no locks are taken.
+# 'snapshot': copy the database into memory, and query the copy.
+DB_MODES=['default','readonly','snapshot']
+
+# pragmas set on all connections
+PRAGMAS=[('cache_size',-256*1024),  # negative: in Kb, i.e. 256 Mb
+        ('mmap_size',256*1024**2),
+        ('temp_store','MEMORY')]
+
+# covering indexes created on snapshots, for the joins of the export:
+# (table, columns). Lookup columns go first, the rest are the columns
+# selected, so queries are answered from the index alone. Columns not in
+# the table (older Mendeley versions) are left out.
+SNAPSHOT_INDEXES=[
+        # getHighlights()
+        ('FileHighlights',['documentId','fileHash','id','profileUuid',
+            'createdTime','author','color']),
+        ('FileHighlightRects',['highlightId','page','x1','y1','x2','y2']),
+        # getNotes()
+        ('FileNotes',['documentId','fileHash','profileUuid','page','x','y',
+            'modifiedTime','author','note']),
+        # getFilePaths(), getHighlights(), getNotes()
+        ('DocumentFiles',['documentId','hash']),
+        ('Files',['hash','localUrl']),
+        # getFolderDocList(), getCanonicals()
+        ('DocumentFolders',['folderId','documentId']),
+        ('DocumentFolders',['documentId','folderId'])
+        ]
+
+
+def getUri(path,**params):
+    '''Get the URI filename of a database file, see sqlite3_open_v2()'''
+
+    query='&'.join(['%s=%s' %(kk,vv) for kk,vv in sorted(params.items())])
+    uri='file:%s' %pathname2url(os.path.abspath(path))
+    if len(query)>0:
+        uri='%s?%s' %(uri,query)
+    return uri
+
+
+def connectUri(uri):
+    '''Connect to a database using a URI filename
+
+    Return <db>: sqlite3.Connection obj, or None if URI filenames are not
+                 supported.
+    '''
+
+    try:
+        return sqlite3.connect(uri,uri=True,factory=queries.Connection)
+    except TypeError:
+        pass
+
+    # python2 has no <uri> argument, URI filenames are only recognized if
+    # sqlite is compiled with SQLITE_USE_URI.
+    mem=sqlite3.connect(':memory:')
+    options=[rowii[0] for rowii in mem.execute('PRAGMA compile_options')]
+    mem.close()
+    if 'USE_URI' in options or 'USE_URI=1' in options:
+        return sqlite3.connect(uri,factory=queries.Connection)
+
+    return None
+
+
+def copyTables(db,path):
+    '''Copy tables and indices of a database into another
+
+    <db>: sqlite3.Connection obj, database to copy into.
+    <path>: str, path of database file to copy.
+
+    For sqlite3 without the backup API (python<3.7). Everything is read
+    in a single transaction, so the copy is consistent. Virtual tables
+    (e.g. full-text search) are not copied.
+    '''
+
+    # python2 sqlite3 commits before each CREATE statement, begin and
+    # commit the transaction explicitly instead
+    isolation=db.isolation_level
+    db.isolation_level=None
+    db.execute('ATTACH DATABASE ? AS src',(path,))
+    try:
+        db.execute('BEGIN')
+        try:
+            rows=db.execute('''SELECT type, name, sql FROM src.sqlite_master
+                    WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
+                    ORDER BY type DESC''').fetchall()
+
+            vtables=[nameii for typeii,nameii,sqlii in rows if\
+                    sqlii.upper().startswith('CREATE VIRTUAL')]
+            isvtable=lambda x: any([x==vii or x.startswith(vii+'_')\
+                    for vii in vtables])
+
+            for typeii,nameii,sqlii in rows:
+                if typeii not in ['table','index'] or isvtable(nameii):
+                    continue
+                db.execute(sqlii)
+                if typeii=='table':
+                    db.execute('INSERT INTO main."%s" SELECT * FROM src."%s"'\
+                            %(nameii,nameii))
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+    finally:
+        db.execute('DETACH DATABASE src')
+        db.isolation_level=isolation
+
+
+def isMemory(db):
+    '''Check if a connection is to an in-memory database, e.g. a snapshot'''
+
+    for rowii in db.execute('PRAGMA database_list'):
+        if rowii[1]=='main':
+            return not rowii[2]
+    return False
+
+
+def createIndexes(db,indexes=SNAPSHOT_INDEXES):
+    '''Create indexes on an in-memory snapshot of the database
+
+    <db>: sqlite3.Connection obj, to an in-memory database.
+    <indexes>: list of (table, columns) tuples.
+
+    Return <num>: int, number of indexes created.
+           <seconds>: float, time used to create the indexes.
+
+    Never changes a database file: raises ValueError if <db> is not an
+    in-memory database. Indexes on missing tables are skipped.
+    '''
+
+    if not isMemory(db):
+        raise ValueError('Indexes are only created on in-memory snapshots.')
+
+    t0=time.time()
+    num=0
+    queryonly=db.execute('PRAGMA query_only').fetchone()[0]
+    db.execute('PRAGMA query_only=0')
+    try:
+        for tableii,columnsii in indexes:
+            existing=[rowjj[1] for rowjj in\
+                    db.execute('PRAGMA table_info("%s")' %tableii)]
+            if len(existing)==0 or columnsii[0] not in existing:
+                continue
+            columnsii=[cjj for cjj in columnsii if cjj in existing]
+            nameii='menotexport_%s_%s' %(tableii,'_'.join(columnsii[:2]))
+            db.execute('CREATE INDEX IF NOT EXISTS "%s" ON "%s" (%s)'\
+                    %(nameii,tableii,', '.join(columnsii)))
+            num+=1
+        db.commit()
+    finally:
+        db.execute('PRAGMA query_only=%d' %queryonly)
+
+    return num,time.time()-t0
+
+
+def connectDb(path,mode='default'):
+    '''Connect to the Mendeley database
+
+    <path>: str, path to the sqlite database file.
+    <mode>: str, one of DB_MODES.
+            'default': plain connection.
+            'readonly': open with mode=ro&immutable=1, never takes locks.
+                        sqlite assumes the file doesn't change, so don't
+                        use it while Mendeley is writing to the library.
+                        Falls back to 'snapshot' if URI filenames are not
+                        supported.
+            'snapshot': copy the database into memory, using the backup
+                        API if available, and query the copy.
+
+    Return <db>: queries.Connection obj, a sqlite3.Connection.
+    '''
+
+    if mode not in DB_MODES:
+        raise ValueError("<mode> should be one of %s" %', '.join(DB_MODES))
+
+    if mode!='default' and not os.path.isfile(path):
+        raise IOError('Database file not found: %s' %path)
+
+    db=None
+    if mode=='readonly':
+        db=connectUri(getUri(path,mode='ro',immutable=1))
+
+    if mode=='snapshot' or mode=='readonly' and db is None:
+        db=sqlite3.connect(':memory:',factory=queries.Connection)
+        if hasattr(db,'backup'):
+            src=connectUri(getUri(path,mode='ro')) or sqlite3.connect(path)
+            src.backup(db)
+            src.close()
+        else:
+            copyTables(db,path)
+
+    if db is None:
+        db=sqlite3.connect(path,factory=queries.Connection)
+
+    for kk,vv in PRAGMAS:
+        db.execute('PRAGMA %s=%s' %(kk,vv))
+    if mode!='default':
+        db.execute('PRAGMA query_only=1')
+    db.schema=queries.Schema(db)
+
+    return db
+
@@ -13,13 +13,80 @@ Update time: 2016-06-22 16:25:15.
 
 import os
 import platform
-#import tools
+import tools
 import re
+import unicodedata
+from collections import OrderedDict
 from pylatexenc import latexencode
 
 import logging
 logging.basicConfig()
 
+# cache size of latexEncode() results, and max length of strings cached
+LATEX_MEMO_SIZE=20000
+LATEX_MEMO_MAXLEN=200
+
+
+#-------------------Encode unicode to latex, fast-------------------
+def _getLatexTable():
+    '''Get unicode.translate() table, and chars encoded without warning
+
+    Same mapping as latexencode.utf8tolatex(s) with default arguments:
+    macros from latexencode.utf82latex are put in brackets, printable
+    ascii chars and \\n\\r\\t are kept.
+    '''
+
+    table={}
+    for kk,vv in latexencode.utf82latex.items():
+        vv=unicode(vv)
+        table[kk]=u'{%s}' %vv if vv[0:1]==u'\\' else vv
+
+    goodchars=set([unichr(ii) for ii in table])
+    goodchars.update([unichr(ii) for ii in range(32,128)])
+    goodchars.update(u'\n\r\t')
+
+    return table,frozenset(goodchars)
+
+_LATEX_TABLE,_LATEX_GOOD=_getLatexTable()
+_NONASCII_RE=re.compile(u'[^\x00-\x7f]')
+_LATEX_MEMO=OrderedDict()
+
+
+def latexEncode(s):
+    '''Encode unicode to latex, same as latexencode.utf8tolatex(s)
+
+    latexencode.utf8tolatex() builds the result one char at a time, which
+    is slow for long abstracts and annotations. This uses a translate
+    table, skips normalization of ascii strings, and caches results of
+    short strings (names, tags, journals) repeated across docs. Strings
+    with chars that can't be encoded go to latexencode.utf8tolatex(),
+    which logs the warnings.
+    '''
+
+    s=unicode(s)
+    if not s:
+        return ""
+
+    memo=len(s)<=LATEX_MEMO_MAXLEN
+    if memo and s in _LATEX_MEMO:
+        result=_LATEX_MEMO.pop(s)
+        _LATEX_MEMO[s]=result
+        return result
+
+    key=s
+    if _NONASCII_RE.search(s):
+        s=unicodedata.normalize('NFC',s)
+    if not _LATEX_GOOD.issuperset(s):
+        return latexencode.utf8tolatex(s)
+
+    result=s.translate(_LATEX_TABLE)
+    if memo:
+        _LATEX_MEMO[key]=result
+        if len(_LATEX_MEMO)>LATEX_MEMO_SIZE:
+            _LATEX_MEMO.popitem(last=False)
+
+    return result
+
 
 
 #------------------------Parse file path entry------------------------
@@ -85,7 +152,7 @@ def parseMeta(metadict,basedir,folder,isfile,iszotero,iskeyword,verbose=True):
     else:
         authors=['%s, %s' %(ii[0],ii[1]) for ii in zip(last,first)]
         authors=' and '.join(authors)
-    authors=latexencode.utf8tolatex(authors)
+    authors=latexEncode(authors)
     
     string='@%s{%s,\n' %(doctype,citekey)
     entries=['author = {%s}' %authors,]
@@ -129,11 +196,11 @@ def parseMeta(metadict,basedir,folder,isfile,iszotero,iskeyword,verbose=True):
 
         #--------------Parse unicode to latex--------------
         if type(vv) is list:
-            fieldvv=[latexencode.utf8tolatex(ii) for ii in vv]
+            fieldvv=[latexEncode(ii) for ii in vv]
         else:
             # Leave file path alone
             if kk!='file':
-                fieldvv=latexencode.utf8tolatex(vv)
+                fieldvv=latexEncode(vv)
             else:
                 fieldvv=vv
 
@@ -150,7 +217,7 @@ def parseMeta(metadict,basedir,folder,isfile,iszotero,iskeyword,verbose=True):
                 tags=[tags,]
             keywords.extend(tags)
 	    keywords=list(set(keywords))
-            fieldvv=[latexencode.utf8tolatex(ii) for ii in keywords]
+            fieldvv=[latexEncode(ii) for ii in keywords]
             kk='keywords'
             gotkeywords=True
 
@@ -191,10 +258,11 @@ def parseMeta(metadict,basedir,folder,isfile,iszotero,iskeyword,verbose=True):
 
 #--------------Export documents with annotations to .bib--------------
 def exportAnno2Bib(annodict,basedir,outdir,allfolders,isfile,iszotero,
-        iskeyword,verbose=True):
+        iskeyword,verbose=True,writer=None,pool=None):
     '''Export documents with annotations to .bib
 
     <annodict>: dict, key: docid, value: menotexport.DocAnno objs.
+    <writer>, <pool>: see exportDoc2Bib().
     '''
 
     #----------------Loop through docs----------------
@@ -227,17 +295,44 @@ def exportAnno2Bib(annodict,basedir,outdir,allfolders,isfile,iszotero,
 
     #----------------------Export----------------------
     faillist=exportDoc2Bib(doclist,basedir,outdir,\
-            allfolders,isfile,iszotero,iskeyword,verbose)
+            allfolders,isfile,iszotero,iskeyword,verbose,writer,pool)
 
     return faillist
 
 
+#------------Format entries of a chunk of docs, in parallel------------
+def _parseMetas(args):
+    '''Format .bib entries of a chunk of docs, can be run in a pool worker
+
+    <args>: tuple, (doclist, basedir, folder, isfile, iszotero, iskeyword),
+            see parseMeta().
+
+    Return <results>: list, .bib entry str of each doc, or None if failed.
+    '''
+
+    doclist,basedir,folder,isfile,iszotero,iskeyword=args
+    results=[]
+    for docii in doclist:
+        try:
+            results.append(parseMeta(docii,basedir,folder,isfile,iszotero,
+                iskeyword))
+        except:
+            results.append(None)
+
+    return results
+
+
 #-------------Export documents without annotations to .bib-------------
-def exportDoc2Bib(doclist,basedir,outdir,allfolders,isfile,iszotero,iskeyword,
-        verbose=True):
+def exportDoc2Bib(doclist,basedir,outdir,allfolders,isfile,iszotero,
+        iskeyword,verbose=True,writer=None,pool=None):
     '''Export documents without annotations to .bib
 
     <doclist>: list of meta data dists.
+    <writer>: tools.OutputWriter obj or None. If None, append to the .bib
+              file directly.
+    <pool>: multiprocessing.Pool obj or None, pool to format entries in
+            parallel, see tools.formatDocs(). Entries are written in the
+            order of <doclist> all the same.
     '''
 
     if allfolders:
@@ -252,13 +347,19 @@ def exportDoc2Bib(doclist,basedir,outdir,allfolders,isfile,iszotero,iskeyword,
     #----------------Loop through docs----------------
     faillist=[]
 
-    for docii in doclist:
+    for docjj,bibdata in tools.formatDocs(_parseMetas,doclist,\
+            (basedir,folder,isfile,iszotero,iskeyword),pool):
+        if bibdata is None:
+            faillist.append(docjj['title'])
+            continue
         try:
-            bibdata=parseMeta(docii,basedir,folder,isfile,iszotero,iskeyword)
-            with open(abpath_out, mode='a') as fout:
-                fout.write(bibdata)
+            if writer is not None:
+                writer.write(abpath_out,bibdata)
+            else:
+                with open(abpath_out, mode='a') as fout:
+                    fout.write(bibdata)
         except:
-            faillist.append(docii['title'])
+            faillist.append(docjj['title'])
 
     return faillist
 
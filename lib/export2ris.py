@@ -241,9 +241,10 @@ def parseMeta(metadict,basedir,folder,isfile,iszotero,iskeyword,verbose=True):
 
 #--------------Export documents with annotations to .ris--------------
 def exportAnno2Ris(annodict,basedir,outdir,allfolders,isfile,iszotero,
-        iskeyword,verbose=True):
+        iskeyword,verbose=True,writer=None,pool=None):
     '''Export documents with annotations to .ris
 
+    <writer>, <pool>: see exportDoc2Ris().
     '''
 
     #----------------Loop through docs----------------
@@ -270,21 +271,50 @@ def exportAnno2Ris(annodict,basedir,outdir,allfolders,isfile,iszotero,
 
     #----------------------Export----------------------
     faillist=exportDoc2Ris(doclist,basedir,outdir,\
-            allfolders,isfile,iszotero,iskeyword,verbose)
+            allfolders,isfile,iszotero,iskeyword,verbose,writer,pool)
 
     return faillist
 
     
 
+#------------Format entries of a chunk of docs, in parallel------------
+def _parseMetas(args):
+    '''Format .ris entries of a chunk of docs, can be run in a pool worker
+
+    <args>: tuple, (doclist, basedir, folder, isfile, iszotero, iskeyword),
+            see parseMeta().
+
+    Return <results>: list, .ris entry str of each doc, or None if failed.
+    '''
+
+    doclist,basedir,folder,isfile,iszotero,iskeyword=args
+    results=[]
+    for docii in doclist:
+        try:
+            results.append(parseMeta(docii,basedir,folder,isfile,iszotero,
+                iskeyword))
+        except:
+            results.append(None)
+
+    return results
+
+
 #-------------Export documents without annotations to .ris-------------
 def exportDoc2Ris(doclist,basedir,outdir,allfolders,isfile,iszotero,
-        iskeyword,verbose=True):
-    '''Export documents without annotations to .bib
-
+        iskeyword,verbose=True,writer=None,pool=None):
+    '''Export documents without annotations to .ris
+
+    <doclist>: list of meta data dists.
+    <writer>: tools.OutputWriter obj or None. If None, append to the .ris
+              file directly.
+    <pool>: multiprocessing.Pool obj or None, pool to format entries in
+            parallel, see tools.formatDocs(). Entries are written in the
+            order of <doclist> all the same.
     '''
 
     if allfolders:
         fileout='Mendeley_lib.ris'
+        folder=''
     else:
         folder=os.path.split(outdir)[-1]
         fileout='Mendeley_lib_%s.ris' %folder
@@ -294,11 +324,19 @@ def exportDoc2Ris(doclist,basedir,outdir,allfolders,isfile,iszotero,
     #----------------Loop through docs----------------
     faillist=[]
 
-    for docii in doclist:
-        risdata=parseMeta(docii,basedir,folder,isfile,iszotero,iskeyword)
-        with open(abpath_out, mode='a') as fout:
-            fout.write(risdata)
-        #faillist.append(docii['title'])
+    for docjj,risdata in tools.formatDocs(_parseMetas,doclist,\
+            (basedir,folder,isfile,iszotero,iskeyword),pool):
+        if risdata is None:
+            faillist.append(docjj['title'])
+            continue
+        try:
+            if writer is not None:
+                writer.write(abpath_out,risdata)
+            else:
+                with open(abpath_out, mode='a') as fout:
+                    fout.write(risdata)
+        except:
+            faillist.append(docjj['title'])
 
     return faillist
 
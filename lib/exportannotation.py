@@ -292,8 +292,36 @@ def _exportAnnoFileTemplated(abpath_out,anno,verbose=True):
         
 
     
+#------------Get path of txt file to export all annotations to------------
+def getAnnoFile(outdir,action,verbose=True):
+    '''Get path of txt file to export annotations of all PDFs to
+
+    <outdir>: str, path to output folder.
+    <action>: list, actions from cli arguments.
+
+    Return <abpath_out>: str, path to output txt file, renamed if exists.
+    '''
+
+    if 'm' in action and 'n' not in action:
+        fileout='Mendeley_highlights.txt'
+    elif 'n' in action and 'm' not in action:
+        fileout='Mendeley_notes.txt'
+    elif 'm' in action and 'n' in action:
+        fileout='Mendeley_annotations.txt'
+
+    abpath_out=os.path.join(outdir,fileout)
+    abpath_out=tools.autoRename(abpath_out)
+
+    if verbose:
+        printInd('Exporting all annotations to:',3)
+        printInd(abpath_out,4)
+
+    return abpath_out
+
+
 #--------------------Export highlights and/or notes--------------------
-def exportAnno(annodict,outdir,action,separate,verbose=True):
+def exportAnno(annodict,outdir,action,separate,verbose=True,abpath_out=None,
+        record=None):
     '''Export highlights and/or notes to txt file
 
     <annodict>: dict, keys: doc ids,
@@ -302,26 +330,18 @@ def exportAnno(annodict,outdir,action,separate,verbose=True):
     <action>: list, actions from cli arguments.
     <separate>: bool, True: save annotations if each PDF separately.
                 False: save annotations from all PDFs to a single file.
+    <abpath_out>: str or None, if <separate> is False, path to txt file
+                  to append annotations to. If None, get one from
+                  getAnnoFile().
+    <record>: function or None, called with the path of each txt file
+              before writing to it, e.g. tools.OutputWriter.record().
 
     Calls _exportAnnoFile() for core processes.
     '''
 
     #-----------Export all to a single file-----------
-    if not separate:
-            
-        if 'm' in action and 'n' not in action:
-            fileout='Mendeley_highlights.txt'
-        elif 'n' in action and 'm' not in action:
-            fileout='Mendeley_notes.txt'
-        elif 'm' in action and 'n' in action:
-            fileout='Mendeley_annotations.txt'
-
-        abpath_out=os.path.join(outdir,fileout)
-        abpath_out=tools.autoRename(abpath_out)
-
-        if verbose:
-            printInd('Exporting all annotations to:',3)
-            printInd(abpath_out,4)
+    if not separate and abpath_out is None:
+        abpath_out=getAnnoFile(outdir,action,verbose)
 
     #----------------Loop through docs----------------
     faillist=[]
@@ -357,6 +377,8 @@ def exportAnno(annodict,outdir,action,separate,verbose=True):
                 printInd(abpath_out,4)
 
         #----------------------Export----------------------
+        if record is not None:
+            record(abpath_out)
         try:
             # Use custom template formatting
             if 't' in action:
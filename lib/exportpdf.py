@@ -12,23 +12,44 @@ Update time: 2016-04-12 22:09:38.
 '''
 
 import os
+import sys
+import re
 import shutil
+try:
+    import fcntl
+except ImportError:
+    # not on windows
+    fcntl=None
 import PyPDF2
+from PyPDF2.generic import IndirectObject, ArrayObject, DictionaryObject,\
+        NameObject, NumberObject
 import pdfannotation
 from tools import printInd, printNumHeader, makedirs
 
+COPY_METHODS=['auto','hardlink','reflink','copy','symlink']
+
+# ioctl request to clone a file on btrfs/xfs (linux/fs.h)
+FICLONE=0x40049409
+
 
 
 #--------------------Export PDFs with annotations--------------
-def exportAnnoPdf(annotations,outdir,verbose=True):
+def exportAnnoPdf(annotations,outdir,verbose=True,exported=None):
     '''Export PDFs
 
     <annotations>: dict, keys: docid, values: menotexport.DocAnno obj.
     <outdir>: str, folder path to save PDFs.
+    <exported>: dict or None, keys: PDF paths, values: paths of PDFs already
+                exported (e.g. into another folder), or None if failed.
+                These are hard-linked or copied instead of exported again.
+                Newly exported PDFs are added to it.
 
     Update time: 2018-07-28 20:21:09.
     '''
 
+    if exported is None:
+        exported={}
+
     faillist=[]
     num=len(annotations)
     for ii,annoii in enumerate(annotations.values()):
@@ -45,20 +66,62 @@ def exportAnnoPdf(annotations,outdir,verbose=True):
             if verbose:
                 printNumHeader('Exporting PDF:',ii+1,num,3)
                 printInd(fnamejj,4)
+
+            #-------------Reuse PDF exported before-------------
+            if fjj in exported:
+                if exported[fjj] is None:
+                    faillist.append(fnamejj)
+                    continue
+                try:
+                    linkPdf(exported[fjj],os.path.join(outdir,fnamejj))
+                    continue
+                except:
+                    pass
+
             try:
                 exportPdf(fjj,outdir,annojj,verbose)
+                exported[fjj]=os.path.join(outdir,fnamejj)
             except:
                 faillist.append(fnamejj)
+                exported[fjj]=None
 
     return faillist
 
 
+#-------------------Link or copy an exported PDF-------------------
+def linkPdf(source,target):
+    '''Hard link <source> to <target>, or copy if linking is not possible
+
+    <source>: str, path to an exported PDF.
+    <target>: str, path to link/copy to.
+    '''
+
+    if os.path.abspath(source)==os.path.abspath(target):
+        return
+    basedir=os.path.dirname(target)
+    if not os.path.isdir(basedir):
+        makedirs(basedir)
+    if os.path.isfile(target):
+        os.remove(target)
+
+    try:
+        os.link(source,target)
+    except:
+        shutil.copy2(source,target)
+
+    return
+
+
 #---------------------Copy PDF to target location---------------------
-def copyPdf(doclist,outdir,verbose=True):
+def copyPdf(doclist,outdir,verbose=True,method='auto'):
     '''Copy PDF to target location
 
     <doclist>: list of meta data dicts
     <outdir>: str, path to output folder
+    <method>: str, how to copy, see copyFile().
+
+    Files whose copy with the same size and modification time exists
+    are skipped.
     '''
     if not os.path.isdir(outdir):
         makedirs(outdir)
@@ -80,18 +143,124 @@ def copyPdf(doclist,outdir,verbose=True):
                 faillist.append(pjj)
                 continue
 
+            if isSameFile(pjj,targetname):
+                continue
+
             if verbose:
                 printNumHeader('Copying file:',ii+1,num,3)
                 printInd(filename,4)
 
             try:
-                shutil.copy2(pjj,targetname)
+                copyFile(pjj,targetname,method)
             except:
                 faillist.append(filename)
 
     return faillist
 
 
+def isSameFile(source,target):
+    '''Check if <target> is a copy of <source> with same size and mtime'''
+
+    if not os.path.exists(target):
+        return False
+    st1=os.stat(source)
+    st2=os.stat(target)
+    return st1.st_size==st2.st_size and int(st1.st_mtime)==int(st2.st_mtime)
+
+
+#-----------------Copy a file using a given method-----------------
+def copyFile(source,target,method='auto'):
+    '''Copy a file using a given method
+
+    <source>: str, path of file to copy.
+    <target>: str, path to copy to.
+    <method>: str, one of COPY_METHODS:
+              'hardlink': hard link <target> to <source>. Changes to
+                          one also change the other.
+              'reflink': copy-on-write clone (btrfs, xfs), which shares
+                         data on disk until either is changed.
+              'symlink': symbolic link to <source>.
+              'copy': copy the data.
+              'auto': try 'reflink', then 'copy'.
+              'hardlink', 'reflink' and 'symlink' fall back to 'copy'
+              if not possible, e.g. across file systems.
+    '''
+
+    if method not in COPY_METHODS:
+        raise Exception("Unknown copy method: %s" %method)
+
+    # avoid writing through an old link to <source>
+    if os.path.lexists(target):
+        os.remove(target)
+
+    try:
+        if method=='hardlink':
+            os.link(source,target)
+            return
+        elif method=='symlink':
+            os.symlink(os.path.abspath(source),target)
+            return
+        elif method in ['reflink','auto']:
+            reflinkFile(source,target)
+            return
+    except:
+        if os.path.lexists(target):
+            os.remove(target)
+
+    copyData(source,target)
+    shutil.copystat(source,target)
+
+
+def reflinkFile(source,target):
+    '''Clone <source> to <target> using the FICLONE ioctl (linux only)'''
+
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise Exception("reflink not supported")
+
+    with open(source,'rb') as fin:
+        with open(target,'wb') as fout:
+            fcntl.ioctl(fout.fileno(),FICLONE,fin.fileno())
+    shutil.copystat(source,target)
+
+
+def copyData(source,target,bufsize=1024**2):
+    '''Copy data of <source> to <target>
+
+    Use os.copy_file_range() or os.sendfile() to copy inside the kernel
+    if available (python3, linux), otherwise read and write in large
+    chunks.
+    '''
+
+    with open(source,'rb') as fin:
+        with open(target,'wb') as fout:
+            size=os.fstat(fin.fileno()).st_size
+            for funcii in ['copy_file_range','sendfile']:
+                func=getattr(os,funcii,None)
+                if func is None:
+                    continue
+                try:
+                    offset=0
+                    while offset<size:
+                        if funcii=='sendfile':
+                            nn=func(fout.fileno(),fin.fileno(),offset,\
+                                    size-offset)
+                        else:
+                            nn=func(fin.fileno(),fout.fileno(),size-offset,\
+                                    offset)
+                        if nn==0:
+                            break
+                        offset+=nn
+                    if offset>=size:
+                        return
+                except OSError:
+                    pass
+                fin.seek(0)
+                fout.seek(0)
+                fout.truncate()
+
+            shutil.copyfileobj(fin,fout,bufsize)
+
+
 #---------------Export pdf---------------
 def exportPdf(fin,outdir,annotations,verbose):
     '''Export PDF with annotations.
@@ -108,6 +277,13 @@ def exportPdf(fin,outdir,annotations,verbose):
     #if not annotations.hasfile:
         #return
 
+    #------Append annotations as an incremental update------
+    try:
+        if exportPdfIncremental(fin,outdir,annotations):
+            return
+    except:
+        pass
+
     try:
         inpdf = PyPDF2.PdfFileReader(open(fin, 'rb'))
         if inpdf.isEncrypted:
@@ -184,3 +360,208 @@ def exportPdf(fin,outdir,annotations,verbose):
 
     return
 
+
+
+#---------Objects to append to a PDF as an incremental update---------
+class IncrementalUpdate(object):
+
+    def __init__(self,size):
+        '''Objects to append to a PDF as an incremental update
+
+        <size>: int, /Size of the PDF, new objects are numbered from it.
+
+        Has _addObject() and getObject() methods as PyPDF2.PdfFileWriter,
+        to be used in pdfannotation.addAnnotation().
+        '''
+
+        self.size=size
+        self.objects={}  # key: (idnum, generation), value: PdfObject
+
+    def _addObject(self,obj):
+        ref=IndirectObject(self.size,0,self)
+        self.objects[(self.size,0)]=obj
+        self.size+=1
+        return ref
+
+    def getObject(self,ref):
+        return self.objects[(ref.idnum,ref.generation)]
+
+    def setObject(self,ref,obj):
+        '''Replace an object in the PDF by a new version'''
+        self.objects[(ref.idnum,ref.generation)]=obj
+
+    def write(self,fout,trailer,prev):
+        '''Append objects, a xref table and trailer to a PDF
+
+        <fout>: file obj, PDF opened in 'ab' mode.
+        <trailer>: DictionaryObject, trailer of the PDF.
+        <prev>: int, offset of the last xref section of the PDF.
+        '''
+
+        fout.seek(0,2)
+        fout.write('\n')
+
+        offsets={}
+        for (idnum,gen),obj in sorted(self.objects.items()):
+            offsets[idnum]=(fout.tell(),gen)
+            fout.write('%d %d obj\n' %(idnum,gen))
+            obj.writeToStream(fout,None)
+            fout.write('\nendobj\n')
+
+        #-----------Xref table, in subsections of consecutive ids-----------
+        xref=fout.tell()
+        fout.write('xref\n0 1\n0000000000 65535 f \n')
+        ids=sorted(offsets.keys())
+        start=0
+        for ii in range(1,len(ids)+1):
+            if ii<len(ids) and ids[ii]==ids[ii-1]+1:
+                continue
+            fout.write('%d %d\n' %(ids[start],ii-start))
+            for idjj in ids[start:ii]:
+                fout.write('%010d %05d n \n' %offsets[idjj])
+            start=ii
+
+        newtrailer=DictionaryObject()
+        for kk in ['/Root','/Info','/ID']:
+            if kk in trailer:
+                newtrailer[NameObject(kk)]=trailer.raw_get(kk)
+        newtrailer[NameObject('/Size')]=NumberObject(self.size)
+        newtrailer[NameObject('/Prev')]=NumberObject(prev)
+
+        fout.write('trailer\n')
+        newtrailer.writeToStream(fout,None)
+        fout.write('\nstartxref\n%d\n%%%%EOF\n' %xref)
+
+
+#-----------Get offset of the last xref section of a PDF-----------
+def getStartXref(fin):
+    '''Get offset of the last xref section of a PDF
+
+    Return <offset>: int, or None if not found or it is a xref stream,
+                     which is not supported in incremental updates here.
+    '''
+
+    with open(fin,'rb') as fpdf:
+        fpdf.seek(0,2)
+        size=fpdf.tell()
+        fpdf.seek(max(0,size-1024))
+        tail=fpdf.read()
+
+        match=re.findall(r'startxref\s+(\d+)',tail)
+        if len(match)==0:
+            return None
+        offset=int(match[-1])
+
+        fpdf.seek(offset)
+        if fpdf.read(4)!='xref':
+            return None
+
+    return offset
+
+
+#------------Get references to page objs of a PDF------------
+def getPageRefs(inpdf):
+    '''Get references to page objs of a PDF, in page order
+
+    <inpdf>: PyPDF2.PdfFileReader obj.
+
+    Return <refs>: list of IndirectObjects, or None if some pages are not
+                   indirect objs.
+    '''
+
+    refs=[]
+
+    def walk(node):
+        for kid in node['/Kids']:
+            if not isinstance(kid,IndirectObject):
+                return False
+            kidobj=kid.getObject()
+            if kidobj.get('/Type')=='/Pages':
+                if not walk(kidobj):
+                    return False
+            else:
+                refs.append(kid)
+        return True
+
+    if not walk(inpdf.trailer['/Root']['/Pages']):
+        return None
+
+    return refs
+
+
+#---------------Export pdf as an incremental update---------------
+def exportPdfIncremental(fin,outdir,annotations):
+    '''Export PDF with annotations, by appending an incremental update.
+
+    <fin>: string, absolute path to input PDF file.
+    <outdir>: string, absolute path to the output directory.
+    <annotations>: FileAnno obj.
+
+    Return: True if done. False if <fin> can not be updated this way,
+            e.g. it has a xref stream or is encrypted, then exportPdf()
+            re-writes the whole PDF instead.
+
+    Bytes of the original PDF are copied as is. Annotation objs,
+    the modified page objs and a xref section are appended to it.
+    '''
+
+    prev=getStartXref(fin)
+    if prev is None:
+        return False
+
+    with open(fin,'rb') as fpdf:
+        inpdf=PyPDF2.PdfFileReader(fpdf)
+        if inpdf.isEncrypted:
+            return False
+
+        pagerefs=getPageRefs(inpdf)
+        if pagerefs is None or len(pagerefs)!=inpdf.getNumPages():
+            return False
+
+        update=IncrementalUpdate(int(inpdf.trailer['/Size']))
+
+        #-------------Loop through annotated pages-------------
+        for pii in annotations.pages:
+            if pii<1 or pii>len(pagerefs):
+                continue
+            pageref=pagerefs[pii-1]
+            inpg=pageref.getObject()
+
+            # the /Annots array is re-written in the page obj
+            if '/Annots' in inpg:
+                inpg[NameObject('/Annots')]=ArrayObject(inpg['/Annots'])
+
+            #----------------Process highlights----------------
+            if pii in annotations.hlpages:
+                for hjj in annotations.highlights[pii]:
+                    anno = pdfannotation.createHighlight(hjj["rect"],
+                            author=hjj['author'],
+                            cdate=hjj["cdate"], color=hjj['color'])
+                    inpg=pdfannotation.addAnnotation(inpg,update,anno)
+
+            #------------------Process notes------------------
+            if pii in annotations.ntpages:
+                for njj in annotations.notes[pii]:
+                    note = pdfannotation.createNote(njj["rect"], \
+                            contents=njj["content"], author=njj["author"],\
+                            cdate=njj["cdate"])
+                    inpg=pdfannotation.addAnnotation(inpg,update,note)
+
+            update.setObject(pageref,inpg)
+
+        trailer=inpdf.trailer
+
+        #-----------------------Save-----------------------
+        filename=annotations.filename
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        abpath_out=os.path.join(outdir,filename)
+        if os.path.isfile(abpath_out):
+            os.remove(abpath_out)
+
+        shutil.copyfile(fin,abpath_out)
+        with open(abpath_out, mode='ab') as fout:
+            update.write(fout,trailer,prev)
+
+    return True
+
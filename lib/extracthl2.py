@@ -28,17 +28,25 @@ from pdfminer.pdfpage import PDFTextExtractionNotAllowed
 from pdfminer.pdfinterp import PDFResourceManager
 from pdfminer.pdfinterp import PDFPageInterpreter
 from pdfminer.pdfdevice import PDFDevice
+from pdfminer.pdftypes import resolve1, dict_value, list_value
+from pdfminer.psparser import LIT
 from pdfminer.layout import LAParams
 from pdfminer.converter import PDFPageAggregator
 from pdfminer.layout import LTTextBox, LTTextLine, LTAnno,\
         LTTextBoxHorizontal, LTTextLineHorizontal, LTChar
 #from numpy import sqrt, argsort
 from math import sqrt
+try:
+    import numpy
+    HAS_NUMPY=True
+except ImportError:
+    HAS_NUMPY=False
 
 from subprocess import Popen, PIPE
 import tools
 import wordfix
 import os
+import re
 
 
 #------Test availability of pdftotext-------------
@@ -55,6 +63,79 @@ def checkPdftotext():
     return isavail
 
 
+# methods to extract highlighted texts, see extractHighlights2()
+METHODS=['pdftotext','pdfminer','numpy']
+
+def getMethod(method='auto'):
+    '''Get the method to extract highlighted texts
+
+    <method>: str, one of METHODS, or 'auto': 'pdftotext' if available,
+              'pdfminer' otherwise.
+
+    Return <method>: str, one of METHODS. 'pdfminer' if <method> is not
+                     available, e.g. 'numpy' without numpy installed.
+    '''
+
+    if method=='auto':
+        method='pdftotext' if checkPdftotext() else 'pdfminer'
+    elif method not in METHODS:
+        raise ValueError("<method> should be 'auto' or one of %s"\
+                %', '.join(METHODS))
+
+    if method=='pdftotext' and not checkPdftotext():
+        return 'pdfminer'
+    if method=='numpy' and not HAS_NUMPY:
+        return 'pdfminer'
+    return method
+
+
+
+# Page and word tags in pdftotext -bbox-layout output
+WORD_PATTERN=re.compile(r'''(<page\b)|<word xMin="([-\d.]+)" yMin="([-\d.]+)"'''\
+        r''' xMax="([-\d.]+)" yMax="([-\d.]+)">(.*?)</word>''',re.S)
+
+
+#------Get word boxes of pages using pdftotext-------------
+def getPageWords(filename,firstpage,lastpage):
+    '''Get word boxes of pages using a single pdftotext call
+
+    <filename>: str, path of PDF.
+    <firstpage>, <lastpage>: int, 1-based page range to read.
+
+    Return <result>: dict, keys: page numbers, values: list of
+                     (xmin,ymin,xmax,ymax,word) tuples, in reading order.
+                     Coordinates in points, origin at top-left.
+                     None if pdftotext fails.
+    '''
+
+    args=['pdftotext','-f',firstpage,'-l',lastpage,'-bbox-layout',\
+            os.path.abspath(filename),'-']
+    args=map(str,args)
+
+    try:
+        pp=Popen(args,stdout=PIPE,stderr=PIPE)
+        out=pp.communicate()[0]
+    except:
+        return None
+    if pp.returncode!=0 or '<page' not in out:
+        return None
+
+    out=tools.deu(out)
+    unescape=lambda x: x.replace('&lt;','<').replace('&gt;','>')\
+            .replace('&quot;','"').replace('&apos;',"'").replace('&amp;','&')
+
+    result={}
+    page=firstpage-1
+    for mii in WORD_PATTERN.finditer(out):
+        if mii.group(1):
+            page+=1
+            result[page]=[]
+        else:
+            xmin,ymin,xmax,ymax=map(float,mii.group(2,3,4,5))
+            result[page].append((xmin,ymin,xmax,ymax,unescape(mii.group(6))))
+
+    return result
+
 
 #------Store highlighted texts with metadata------
 class Anno(object):
@@ -105,11 +186,171 @@ Is general note:    %s
 
 
 
+#-----------Grid index of chars in text boxes of a page-----------
+class PageIndex(object):
+
+    def __init__(self,objs,cellsize=20.):
+        '''Grid index of chars in text boxes of a page
+
+        <objs>: list, layout objs of a page.
+        <cellsize>: float, size of grid cells, in points.
+
+        Built once for a page, so that findStrFromBox() only tests chars
+        near a highlight, rather than all chars in a box for each
+        highlight. Also keeps the sorted lines and gaps of each box.
+        '''
+
+        self.cellsize=float(cellsize)
+        self.grid={}   # key: (col, row), value: list of (line, char index)
+        self.annos={}  # key: id(line), value: indices of LTAnnos in line
+        self.lines={}  # key: id(box), value: (sorted lines, linegap, chargap)
+        self.hits={}   # key: highlight rect, value: query result
+
+        for boxii in objs:
+            if type(boxii)!=LTTextBox and type(boxii)!=LTTextBoxHorizontal:
+                continue
+            for lineii in boxii._objs:
+                if type(lineii)!=LTTextLine and\
+                        type(lineii)!=LTTextLineHorizontal:
+                    continue
+                annosii=[]
+                for jj,charjj in enumerate(lineii._objs):
+                    if type(charjj)==LTAnno:
+                        annosii.append(jj)
+                    elif type(charjj)==LTChar:
+                        self.addChar(lineii,jj,charjj)
+                self.annos[id(lineii)]=annosii
+
+    def addChar(self,line,idx,char):
+        for cellii in self.getCells(char.bbox):
+            self.grid.setdefault(cellii,[]).append((line,idx))
+
+    def getCells(self,bbox):
+        x0,y0,x1,y1=bbox
+        x0,x1=min(x0,x1),max(x0,x1)
+        y0,y1=min(y0,y1),max(y0,y1)
+        size=self.cellsize
+        for ii in range(int(x0//size),int(x1//size)+1):
+            for jj in range(int(y0//size),int(y1//size)+1):
+                yield ii,jj
+
+    def getLines(self,box):
+        '''Get sorted lines of a box, and line and char gaps'''
+
+        if id(box) not in self.lines:
+            lines=sortY(box._objs)
+            linegap,chargap=measureGap(lines)
+            self.lines[id(box)]=(lines,linegap,chargap)
+        return self.lines[id(box)]
+
+    def query(self,rect):
+        '''Get chars overlapping a highlight
+
+        <rect>: list, [x1,y1,x2,y2] of a highlight.
+
+        Return <result>: dict, keys: id(line), values: sorted indices of
+                         LTChars in line that overlap <rect>, in the same
+                         sense as LTComponent.is_hoverlap()/is_voverlap().
+        '''
+
+        key=tuple(rect)
+        if key in self.hits:
+            return self.hits[key]
+
+        x0,y0,x1,y1=rect
+        result={}
+        seen=set()
+        for cellii in self.getCells(rect):
+            for lineii,jj in self.grid.get(cellii,[]):
+                if (id(lineii),jj) in seen:
+                    continue
+                seen.add((id(lineii),jj))
+                charjj=lineii._objs[jj]
+                if charjj.x0<=x1 and x0<=charjj.x1 and\
+                        charjj.y0<=y1 and y0<=charjj.y1:
+                    result.setdefault(id(lineii),[]).append(jj)
+
+        for vv in result.values():
+            vv.sort()
+        self.hits[key]=result
+
+        return result
+
+    def getText(self,line,rect):
+        '''Get texts of LTAnnos and of LTChars overlapping <rect> in a line
+
+        Same as looping through all objs in <line>.
+        '''
+
+        idx=self.query(rect).get(id(line),[])+self.annos.get(id(line),[])
+        idx.sort()
+        return [line._objs[ii].get_text() for ii in idx]
+
+
+#-------Overlaps of all chars and highlights of a page in numpy-------
+class PageArray(PageIndex):
+
+    def __init__(self,objs,anno):
+        '''Overlaps of all chars and highlights of a page, using numpy
+
+        <objs>: list, layout objs of a page.
+        <anno>: list, highlights in the page, each a dict with a 'rect' key.
+
+        Char bboxes are packed into a (N,4) array, highlight rects into
+        a (M,4) array, and the (M,N) overlap mask is computed at once.
+        Gives the same results as PageIndex.
+        '''
+
+        self.chars=[]  # (line, char index), in the same order as bboxes
+        self.bboxes=[]
+        PageIndex.__init__(self,objs)
+        self.bboxes=numpy.array(self.bboxes,dtype='float64').reshape(-1,4)
+
+        rects=list(set([tuple(hii['rect']) for hii in anno]))
+        self.hits.update(zip(rects,self.getOverlaps(rects)))
+
+    def addChar(self,line,idx,char):
+        self.chars.append((line,idx))
+        self.bboxes.append(char.bbox)
+
+    def getOverlaps(self,rects):
+        '''Get chars overlapping each of a list of rects
+
+        <rects>: list, each an [x1,y1,x2,y2] rect.
+
+        Return <results>: list, for each rect, a dict like PageIndex.query().
+        '''
+
+        results=[{} for rectii in rects]
+        if len(rects)==0 or len(self.chars)==0:
+            return results
+
+        bboxes=self.bboxes
+        rects=numpy.array(rects,dtype='float64').reshape(-1,4)
+        mask=(bboxes[:,0]<=rects[:,2:3]) & (rects[:,0:1]<=bboxes[:,2]) &\
+                (bboxes[:,1]<=rects[:,3:4]) & (rects[:,1:2]<=bboxes[:,3])
+
+        for ii,jj in zip(*numpy.nonzero(mask)):
+            lineii,kk=self.chars[jj]
+            results[ii].setdefault(id(lineii),[]).append(kk)
+
+        return results
+
+    def query(self,rect):
+        key=tuple(rect)
+        if key not in self.hits:
+            self.hits[key]=self.getOverlaps([key])[0]
+        return self.hits[key]
+
+
 #-------Locate and extract strings from a page layout obj-------
-def findStrFromBox(anno,box,verbose=True):
+def findStrFromBox(anno,box,verbose=True,index=None):
     '''Locate and extract strings from a page layout obj
 
     Extract text using pdfminer
+
+    <index>: PageIndex obj or None, index of chars in page. If given, only
+             chars near a highlight are tested.
     '''
 
     texts=u''
@@ -127,7 +368,11 @@ def findStrFromBox(anno,box,verbose=True):
             textii=[]
             num+=1
 
-            lines=sortY(box._objs)
+            if index is None:
+                lines=sortY(box._objs)
+                linegap,chargap=measureGap(lines)
+            else:
+                lines,linegap,chargap=index.getLines(box)
 
             #----------------Loop through lines----------------
             for lineii in lines:
@@ -136,6 +381,10 @@ def findStrFromBox(anno,box,verbose=True):
                     continue
                 if lineii.is_hoverlap(dummy) and\
                         lineii.is_voverlap(dummy):
+                    if index is not None:
+                        textii.extend(index.getText(lineii,dummy.bbox))
+                        continue
+
                     #chars=sortX(lineii._objs)
                     chars=lineii._objs
 
@@ -162,7 +411,6 @@ def findStrFromBox(anno,box,verbose=True):
                 joiner=u' '
 
             #---------------Jump---------------
-            linegap,chargap=measureGap(lines)
             textii=textii.strip()
             if ii==0 or len(texts)==0:
                 texts+=joiner+textii
@@ -186,11 +434,19 @@ def findStrFromBox(anno,box,verbose=True):
 
 
 #-------Locate and extract strings from a page layout obj-------
-def findStrFromBox2(anno,box,filename,pheight,verbose=True):
+def findStrFromBox2(anno,box,filename,pheight,words=None,verbose=True,\
+        index=None):
     '''Locate and extract strings from a page layout obj
 
     Extract text using pdftotext
 
+    <words>: list or None, word boxes in the page, see getPageWords().
+             If given, texts are taken from words whose centers are
+             inside a highlight, otherwise pdftotext is called for
+             each highlight.
+    <index>: PageIndex obj or None, index of page, to get sorted lines
+             of <box>.
+
     Update time: 2018-07-30 09:48:38.
     '''
 
@@ -213,7 +469,11 @@ def findStrFromBox2(anno,box,filename,pheight,verbose=True):
             textii=[]
             num+=1
 
-            lines=sortY(box._objs)
+            if index is None:
+                lines=sortY(box._objs)
+                linegap,chargap=measureGap(lines)
+            else:
+                lines,linegap,chargap=index.getLines(box)
 
             #----------------Loop through lines----------------
             for lineii in lines:
@@ -223,6 +483,16 @@ def findStrFromBox2(anno,box,filename,pheight,verbose=True):
                 if lineii.is_hoverlap(dummy) and\
                         lineii.is_voverlap(dummy):
 
+                    #--------Get words inside highlight from page--------
+                    if words is not None:
+                        x1,y1,x2,y2=hiibox
+                        y1,y2=pheight-y2,pheight-y1
+                        tii=[ww[4] for ww in words if\
+                                x1<=(ww[0]+ww[2])/2.<=x2 and\
+                                y1<=(ww[1]+ww[3])/2.<=y2]
+                        textii.append(u' '.join(tii))
+                        break
+
                     #------Call pdftotext and save to a temp file------
                     # NOTE: pdftotext coordinate has origin at top-left.
                     # Coordinates from Mendeley has origin at bottom-left.
@@ -270,7 +540,6 @@ def findStrFromBox2(anno,box,filename,pheight,verbose=True):
                 joiner=u' '
 
             #---------------Jump---------------
-            linegap,chargap=measureGap(lines)
             textii=textii.strip()
             if ii==0 or len(texts)==0:
                 texts+=joiner+textii
@@ -551,9 +820,123 @@ def sortAnnoY(objs,verbose=True):
     return result
 
 
+#---------------Get page objs of selected pages---------------
+def _enumPages(document,pagenums):
+    '''Get page objs of selected pages, walking all pages, see getPages()'''
+
+    lastpage=max(pagenums)
+    for ii,page in enumerate(PDFPage.create_pages(document)):
+        if ii+1 in pagenums:
+            yield ii,page
+        if ii+1>=lastpage:
+            break
+
+
+def getPages(document,pagenums):
+    '''Get page objs of selected pages, skipping other pages
+
+    <document>: PDFDocument obj.
+    <pagenums>: list of ints, 1-based numbers of pages to get.
+
+    Return: generator of (ii, page) tuples, in ascending page order.
+            ii: int, 0-based index of the page. page: PDFPage obj.
+
+    Same as enumerate(PDFPage.create_pages(document)) but only for pages
+    in <pagenums>. Page tree nodes without any of these pages are skipped
+    using their /Count, and the walk stops after the last page in
+    <pagenums>.
+
+    Kids of a node are resolved one at a time, none after the last page.
+    The /Count of a node walked to its end is checked against the pages
+    and /Count of its kids. If they don't match (broken PDFs), or no page
+    is found, all pages are walked as PDFPage.create_pages() does. /Count
+    of nodes skipped before the walk stops is trusted.
+    '''
+
+    pagenums=set(pagenums)
+    if len(pagenums)==0:
+        return
+
+    if 'Pages' not in document.catalog:
+        for xx in _enumPages(document,pagenums):
+            yield xx
+        return
+
+    lastpage=max(pagenums)
+    counter=[0]   # number of pages passed
+    found=[]      # (ii, objid, tree) of pages found
+
+    def getCount(obj):
+        # number of pages under a page tree node, None if not known
+        try:
+            tree=dict_value(obj)
+            if tree.get('Type') is LIT('Page'):
+                return 1
+            count=resolve1(tree['Count'])
+            if isinstance(count,int) and count>=0:
+                return count
+        except:
+            pass
+        return None
+
+    def search(obj,parent):
+        # return False if /Count of a node doesn't match its pages
+        if isinstance(obj,int):
+            objid=obj
+            tree=dict_value(document.getobj(objid)).copy()
+        else:
+            objid=obj.objid
+            tree=dict_value(obj).copy()
+        for kk,vv in parent.iteritems():
+            if kk in PDFPage.INHERITABLE_ATTRS and kk not in tree:
+                tree[kk]=vv
+
+        if tree.get('Type') is LIT('Pages') and 'Kids' in tree:
+            start=counter[0]
+            for cii in list_value(tree['Kids']):
+                if counter[0]>=lastpage:
+                    return True
+                # kids after the last page are not resolved
+                countii=getCount(cii)
+                if countii is not None and not any(counter[0]<pii<=\
+                        counter[0]+countii for pii in pagenums):
+                    counter[0]+=countii
+                    continue
+                if not search(cii,tree):
+                    return False
+
+            # only checked for nodes walked to the end
+            count=getCount(tree)
+            if count is not None and counter[0]-start!=count:
+                return False
+        elif tree.get('Type') is LIT('Page'):
+            counter[0]+=1
+            if counter[0] in pagenums:
+                found.append((counter[0]-1,objid,tree))
+
+        return True
+
+    try:
+        isvalid=search(document.catalog['Pages'],document.catalog)
+    except RuntimeError:
+        # recursion too deep, e.g. a loop in the page tree
+        isvalid=False
+
+    if not isvalid or len(found)==0:
+        for xx in _enumPages(document,pagenums):
+            yield xx
+        return
+
+    for ii,objid,tree in found:
+        yield ii,PDFPage(document,objid,tree)
+
+
 #------------------------Initiate analysis objs------------------------
-def init(filename,verbose=True):
+def init(filename,verbose=True,laparams=None):
     '''Initiate analysis objs
+
+    <laparams>: LAParams obj or None, parameters for layout analysis.
+                If None, use default.
     '''
 
     fp = open(filename, 'rb')
@@ -572,7 +955,8 @@ def init(filename,verbose=True):
     # Create a PDF interpreter object.
     interpreter = PDFPageInterpreter(rsrcmgr, device)
     # Set parameters for analysis.
-    laparams = LAParams()
+    if laparams is None:
+        laparams = LAParams()
 
     # Create a PDF page aggregator object.
     device = PDFPageAggregator(rsrcmgr, laparams=laparams)
@@ -581,6 +965,63 @@ def init(filename,verbose=True):
     return document, interpreter, device
 
 
+#-----------------Get layouts of selected pages-----------------
+def getLayouts(filename,pagenums,filehash=None,cache=None):
+    '''Get layouts of selected pages, using cached ones if possible
+
+    <filename>: str, path of PDF.
+    <pagenums>: list of ints, 1-based numbers of pages to get.
+    <filehash>: str or None, hash of the PDF, used as key in <cache>.
+    <cache>: layoutcache.LayoutCache obj or None. If given and <filehash>
+             is not None, layouts are read from/saved to it.
+
+    Return: generator of (ii, layout) tuples, in ascending page order.
+            ii: int, 0-based index of the page. layout: LTPage obj.
+
+    The PDF is only parsed if some pages are not found in <cache>.
+    '''
+
+    pagenums=sorted(set(pagenums))
+    laparams=LAParams()
+    if filehash is None:
+        cache=None
+
+    if cache is not None:
+        misses=[pii for pii in pagenums if not\
+                cache.has(filehash,pii,laparams)]
+    else:
+        misses=pagenums
+
+    analyzer=[]  # pdfminer instances, created when needed
+
+    def analyze(pnums):
+        if len(analyzer)==0:
+            analyzer.extend(init(filename,laparams=laparams))
+        document,interpreter,device=analyzer
+        for ii,page in getPages(document,pnums):
+            interpreter.process_page(page)
+            layout=device.get_result()
+            if cache is not None:
+                cache.put(filehash,ii+1,laparams,layout)
+            yield ii,layout
+
+    pages=analyze(misses) if len(misses)>0 else iter([])
+
+    missset=set(misses)
+    for pii in pagenums:
+        if pii in missset:
+            yield next(pages)
+            continue
+
+        layout=cache.get(filehash,pii,laparams)
+        if layout is None:
+            # cache file removed or corrupted after checking
+            for xx in analyze([pii]):
+                yield xx
+        else:
+            yield pii-1,layout
+
+
 #----------------Get the latest creation time of annos----------------
 def getCtime(annos,verbose=True):
     '''Get the latest creation time of a list of annos
@@ -670,28 +1111,37 @@ def extractHighlights(filename,anno,verbose=True):
 
 
 #----------------Extract highlighted texts from a PDF--------
-def extractHighlights2(filename,anno,method,verbose=True):
+def extractHighlights2(filename,anno,method,verbose=True,cache=None):
     '''Extract highlighted texts from a PDF
 
     <filename>: str, path of PDF to extract highlights from.
     <anno>: menotexport.FileAnno obj.
-    <method>: str, software to extract texts, 'pdfminer' or 'pdftotext'.
+    <method>: str, software to extract texts, one of METHODS: 'pdfminer',
+              'pdftotext' or 'numpy'. 'numpy' is the same as 'pdfminer' but
+              matches chars to highlights in numpy arrays, see getMethod().
+    <cache>: layoutcache.LayoutCache obj or None, cache of page layouts.
 
     Return <hltexts>: list of Anno objs.
     '''
 
+    if method=='numpy' and not HAS_NUMPY:
+        raise ImportError("Method 'numpy' needs numpy, which is not installed.")
+
     hlpages=anno.hlpages
     if len(hlpages)==0:
         return []
 
-    #--------------Get pdfminer instances--------------
-    document, interpreter, device=init(filename)
+    #-----Get words of highlighted pages in one call-----
+    if method=='pdftotext':
+        pagewords=getPageWords(filename,min(hlpages),max(hlpages))
+    else:
+        pagewords=None
 
     #----------------Loop through pages----------------
     hltexts=[]
     authors=tools.getAuthorList(anno.meta)
 
-    for ii,page in enumerate(PDFPage.create_pages(document)):
+    for ii,layout in getLayouts(filename,hlpages,anno.hash,cache):
 
         #------------Get highlights in page------------
         if ii+1 in hlpages:
@@ -706,9 +1156,11 @@ def extractHighlights2(filename,anno,method,verbose=True):
             #-----------Sort annotations vertically-----------
             annoii=sortAnnoY(annoii)
 
-            interpreter.process_page(page)
-            layout = device.get_result()
             page_height=layout.height
+            if pagewords is None:
+                wordsii=None
+            else:
+                wordsii=pagewords.get(ii+1,[])
 
             #--------------Sort boxes diagnoally--------------
             objs=sortDiag(layout)
@@ -716,6 +1168,12 @@ def extractHighlights2(filename,anno,method,verbose=True):
             #-----------------Refine ordering-----------------
             objs=fineTuneOrder(objs)
 
+            #-----------------Index chars in page-----------------
+            if method=='numpy':
+                index=PageArray(objs,annoii)
+            else:
+                index=PageIndex(objs)
+
             #----------------Loop through boxes----------------
             for jj,objj in enumerate(objs):
 
@@ -724,9 +1182,10 @@ def extractHighlights2(filename,anno,method,verbose=True):
                     continue
 
                 if method=='pdftotext':
-                    textjj,numjj=findStrFromBox2(annoii,objj,filename,page_height)
-                elif method=='pdfminer':
-                    textjj,numjj=findStrFromBox(annoii,objj)
+                    textjj,numjj=findStrFromBox2(annoii,objj,filename,\
+                            page_height,wordsii,index=index)
+                elif method=='pdfminer' or method=='numpy':
+                    textjj,numjj=findStrFromBox(annoii,objj,index=index)
 
                 if numjj>0:
                     #--------------Attach text with meta--------------
@@ -11,6 +11,8 @@ Update time: 2018-08-06 21:42:42.
 '''
 
 import os
+import shutil
+import tempfile
 from textwrap import TextWrapper
 from tools import printHeader, printInd, printNumHeader, removeDupGeneralNotes
 
@@ -56,13 +58,9 @@ def groupByTags(annodict,verbose=True):
 
 
 
-#--------------Export annotations grouped by tags------------------
-def exportAnno(annodict,outdir,action,verbose=True):
-    '''Export annotations grouped by tags
-
-    '''
+#-------------Get path of file to save annotations by tags-------------
+def getTagsFile(outdir,action):
 
-    #-----------Export all to a single file-----------
     if 'm' in action and 'n' not in action:
         fileout='Mendeley_highlights_by_tags.txt'
     elif 'n' in action and 'm' not in action:
@@ -70,13 +68,36 @@ def exportAnno(annodict,outdir,action,verbose=True):
     elif 'm' in action and 'n' in action:
         fileout='Mendeley_annotations_by_tags.txt'
 
-    abpath_out=os.path.join(outdir,fileout)
-    if os.path.isfile(abpath_out):
-        os.remove(abpath_out)
+    return os.path.join(outdir,fileout)
+
+
+def sortTags(tags):
+    '''Sort tags, put @None at the end'''
+
+    tags=sorted(tags)
+    if '@None' in tags:
+        tags.remove('@None')
+        tags.append('@None')
+    return tags
 
-    if verbose:
-        printHeader('Exporting all taged annotations to:',3)
-        printInd(abpath_out,4)
+
+#--------------Format annotations of a tag------------------
+def formatTag(tag):
+
+    conv=lambda x:unicode(x)
+    outstr=u'''\n\n{0}\n# {1}'''.format(int(80)*'-', conv(tag))
+    return outstr.encode('ascii','replace')
+
+
+def formatCite(citekey,annos):
+    '''Format highlights and notes of a doc under a tag
+
+    <citekey>: str, citation key of doc.
+    <annos>: dict, {'highlights': list of Anno objs,
+                    'notes': list of Anno objs}.
+
+    Return <result>: str, ascii encoded string.
+    '''
 
     conv=lambda x:unicode(x)
 
@@ -92,68 +113,146 @@ def exportAnno(annodict,outdir,action,verbose=True):
     #wrapper2.subsequent_indent='\t\t\t'+int(len('Title: '))*' '
     wrapper2.subsequent_indent='\t\t\t'
 
-    with open(abpath_out, mode='a') as fout:
+    hljj=annos['highlights']
+    ntjj=annos['notes']
 
-        #----------------Loop through tags----------------
-        tags=annodict.keys()
-        if len(tags)==0:
-            return
-        tags.sort()
-        #---------------Put @None at the end---------------
-        if '@None' in tags:
-            tags.remove('@None')
-            tags.append('@None')
+    outstr=u'''\n\n\t@{0}:'''.format(conv(citekey))
+    result=[outstr.encode('ascii','replace')]
 
-        for tagii in tags:
+    #-----------------Write highlights-----------------
+    if len(hljj)>0:
 
-            citedictii=annodict[tagii]
-            outstr=u'''\n\n{0}\n# {1}'''.format(int(80)*'-', conv(tagii))
-            outstr=outstr.encode('ascii','replace')
-            fout.write(outstr)
-
-            #--------------Loop through cite keys--------------
-            for citejj, annosjj in citedictii.items():
-                hljj=annosjj['highlights']
-                ntjj=annosjj['notes']
-
-                outstr=u'''\n\n\t@{0}:'''.format(conv(citejj))
-                outstr=outstr.encode('ascii','replace')
-                fout.write(outstr)
-
-                #-----------------Write highlights-----------------
-                if len(hljj)>0:
-
-                    #-------------Loop through highlights-------------
-                    for hlkk in hljj:
-                        hlstr=wrapper.fill(hlkk.text)
-                        title=wrapper2.fill(hlkk.title)
-                        outstr=u'''
+        #-------------Loop through highlights-------------
+        for hlkk in hljj:
+            hlstr=wrapper.fill(hlkk.text)
+            title=wrapper2.fill(hlkk.title)
+            outstr=u'''
 \n\t\t> {0}
 
 \t\t\t- Title: {1}
 \t\t\t- Ctime: {2}'''.format(*map(conv,[hlstr, title,\
-                      hlkk.ctime]))
+              hlkk.ctime]))
 
-                        outstr=outstr.encode('ascii','replace')
-                        fout.write(outstr)
+            result.append(outstr.encode('ascii','replace'))
 
-                #-----------------Write notes-----------------
-                if len(ntjj)>0:
+    #-----------------Write notes-----------------
+    if len(ntjj)>0:
 
-                    #----------------Loop through notes----------------
-                    for ntkk in ntjj:
-                        ntstr=wrapper.fill(ntkk.text)
-                        title=wrapper2.fill(ntkk.title)
-                        outstr=u'''
+        #----------------Loop through notes----------------
+        for ntkk in ntjj:
+            ntstr=wrapper.fill(ntkk.text)
+            title=wrapper2.fill(ntkk.title)
+            outstr=u'''
 \n\t\t- {0}
 
 \t\t\t- Title: {1}
 \t\t\t- Ctime: {2}'''.format(*map(conv,[ntstr, title,\
-                    ntkk.ctime]))
+            ntkk.ctime]))
+
+            result.append(outstr.encode('ascii','replace'))
 
-                        outstr=outstr.encode('ascii','replace')
-                        fout.write(outstr)
+    return ''.join(result)
+
+
+#--------------Export annotations grouped by tags------------------
+def exportAnno(annodict,outdir,action,verbose=True):
+    '''Export annotations grouped by tags
+
+    '''
+
+    #-----------Export all to a single file-----------
+    abpath_out=getTagsFile(outdir,action)
+    if os.path.isfile(abpath_out):
+        os.remove(abpath_out)
 
-        
+    if verbose:
+        printHeader('Exporting all taged annotations to:',3)
+        printInd(abpath_out,4)
+
+    with open(abpath_out, mode='a') as fout:
+
+        #----------------Loop through tags----------------
+        tags=sortTags(annodict.keys())
+
+        for tagii in tags:
+
+            citedictii=annodict[tagii]
+            fout.write(formatTag(tagii))
+
+            #--------------Loop through cite keys--------------
+            for citejj, annosjj in citedictii.items():
+                fout.write(formatCite(citejj,annosjj))
+
+
+#--------------Spool annotations grouped by tags------------------
+class TagSpool(object):
+
+    def __init__(self,spooldir=None,record=None):
+        '''Collect annotations grouped by tags from batches of docs
+
+        <spooldir>: str or None, folder to save tmp files. If None, create
+                    a tmp folder.
+        <record>: function or None, called with the path of each tmp file
+                  before created.
+
+        Annotations of each tag are appended to a tmp file, so they are
+        not kept in memory until all docs in a folder are processed.
+        Call export() to write them into one file, same as exportAnno(),
+        and close() to remove the tmp files.
+        '''
+
+        self.spooldir=spooldir
+        self.files={}  # key: tag, value: path of tmp file
+        self.record=record
+
+    def add(self,annodict):
+        '''Add annotations grouped by tags
+
+        <annodict>: dict, output from groupByTags().
+        '''
+
+        if self.spooldir is None:
+            self.spooldir=tempfile.mkdtemp(prefix='menotexport_tags_')
+        elif not os.path.isdir(self.spooldir):
+            os.makedirs(self.spooldir)
+
+        for tagii,citedictii in annodict.items():
+            if tagii not in self.files:
+                self.files[tagii]=os.path.join(self.spooldir,\
+                        '%d.txt' %len(self.files))
+                if self.record is not None:
+                    self.record(self.files[tagii])
+            with open(self.files[tagii], mode='a') as fout:
+                for citejj, annosjj in citedictii.items():
+                    fout.write(formatCite(citejj,annosjj))
+
+    def export(self,outdir,action,verbose=True,record=None):
+        '''Export spooled annotations grouped by tags
+
+        <record>: function or None, called with the path of the output
+                  file before writing to it.
+        '''
+
+        abpath_out=getTagsFile(outdir,action)
+        if os.path.isfile(abpath_out):
+            os.remove(abpath_out)
+        if record is not None:
+            record(abpath_out)
+
+        if verbose:
+            printHeader('Exporting all taged annotations to:',3)
+            printInd(abpath_out,4)
+
+        with open(abpath_out, mode='a') as fout:
+            for tagii in sortTags(self.files.keys()):
+                fout.write(formatTag(tagii))
+                if os.path.exists(self.files[tagii]):
+                    with open(self.files[tagii],'rb') as fin:
+                        shutil.copyfileobj(fin,fout)
+
+    def close(self):
+        if self.spooldir is not None:
+            shutil.rmtree(self.spooldir,ignore_errors=True)
+            self.spooldir=None
+            self.files={}
 
-    
@@ -0,0 +1,168 @@
+'''
+On-disk cache of pdfminer page layouts.
+
+Layout analysis of a page is the slowest step in extracting highlights,
+but attached PDFs rarely change between exports. Layouts are saved to
+a cache folder, keyed by the hash of the PDF (Files.hash in Mendeley),
+the page number, the layout analysis parameters and the pdfminer
+version. The least recently
+used entries are removed when the folder gets larger than a size limit.
+'''
+import os
+import zlib
+import hashlib
+import tempfile
+import cPickle as pickle
+import pdfminer
+
+# bump this if the layout objs or how they are used change
+CACHE_VERSION=1
+DEFAULT_MAX_SIZE=500  # in Mb
+SUFFIX='.layout'
+# fraction of max size a process writes before it checks the folder size
+SYNC_FRACTION=0.1
+
+# cache files are readable by all, so a cache folder can be shared
+_umask=os.umask(0)
+os.umask(_umask)
+FILE_MODE=0644 & ~_umask
+
+
+class LayoutCache(object):
+
+    def __init__(self,cachedir,maxsize=DEFAULT_MAX_SIZE):
+        '''Cache of page layouts (pdfminer LTPage objs).
+
+        <cachedir>: str, folder to save cached layouts.
+        <maxsize>: int or float, max size of <cachedir> in Mb.
+        '''
+
+        self.cachedir=os.path.abspath(cachedir)
+        self.maxsize=int(maxsize*1024**2)
+        self.size=None  # total size of cached files, got when needed
+        self.added=0    # size written by this process since size was got
+
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    def getPath(self,filehash,page,laparams):
+        '''Get the path of the cache file of a page
+
+        <filehash>: str, hash of the PDF file.
+        <page>: int, 1-based page number.
+        <laparams>: pdfminer LAParams obj, used in layout analysis.
+        '''
+
+        params=sorted(vars(laparams).items()) if laparams else None
+        # pickles of layout objs may not load in other pdfminer versions
+        key=repr((CACHE_VERSION,getattr(pdfminer,'__version__',None),
+            filehash,page,params))
+        key=hashlib.sha1(key).hexdigest()
+
+        return os.path.join(self.cachedir,key+SUFFIX)
+
+    def has(self,filehash,page,laparams):
+        return os.path.exists(self.getPath(filehash,page,laparams))
+
+    def get(self,filehash,page,laparams):
+        '''Get the cached layout of a page
+
+        Return <layout>: LTPage obj, or None if not cached or failed to load.
+        '''
+
+        path=self.getPath(filehash,page,laparams)
+        try:
+            with open(path,'rb') as fin:
+                layout=pickle.loads(zlib.decompress(fin.read()))
+            # mark as recently used
+            os.utime(path,None)
+        except:
+            return None
+
+        return layout
+
+    def put(self,filehash,page,laparams,layout):
+        '''Save the layout of a page to cache
+
+        Layouts that can not be pickled are not saved.
+        '''
+
+        path=self.getPath(filehash,page,laparams)
+        try:
+            data=zlib.compress(pickle.dumps(layout,pickle.HIGHEST_PROTOCOL))
+        except:
+            return
+
+        # write to a tmp file first, so other processes never read half
+        # written files.
+        tmppath=None
+        oldsize=0
+        try:
+            fd,tmppath=tempfile.mkstemp(dir=self.cachedir)
+            with os.fdopen(fd,'wb') as fout:
+                fout.write(data)
+            # mkstemp() creates files only readable by the owner
+            os.chmod(tmppath,FILE_MODE)
+            if os.path.exists(path):
+                oldsize=os.path.getsize(path)
+                if os.name=='nt':
+                    os.remove(path)
+            os.rename(tmppath,path)
+        except:
+            if tmppath is not None and os.path.exists(tmppath):
+                os.remove(tmppath)
+            return
+
+        # other processes (e.g. pool workers) write to the same folder,
+        # get the size again after writing a part of the max size, and
+        # before evicting
+        self.added+=len(data)-oldsize
+        if self.size is None or self.added>=self.maxsize*SYNC_FRACTION or\
+                self.size+self.added>self.maxsize:
+            self.size=self.getSize()
+            self.added=0
+        if self.size+self.added>self.maxsize:
+            self.evict()
+
+    def getSize(self):
+        '''Get the total size of cached files'''
+
+        size=0
+        for fii in os.listdir(self.cachedir):
+            if fii.endswith(SUFFIX):
+                try:
+                    size+=os.path.getsize(os.path.join(self.cachedir,fii))
+                except OSError:
+                    pass
+        return size
+
+    def evict(self):
+        '''Remove least recently used files until cache is below 90% of
+        max size
+        '''
+
+        files=[]
+        for fii in os.listdir(self.cachedir):
+            if not fii.endswith(SUFFIX):
+                continue
+            pii=os.path.join(self.cachedir,fii)
+            try:
+                files.append((os.path.getmtime(pii),os.path.getsize(pii),pii))
+            except OSError:
+                pass
+        files.sort()
+
+        size=sum([fii[1] for fii in files])
+        target=int(self.maxsize*0.9)
+        for mtimeii,sizeii,pii in files:
+            if size<=target:
+                break
+            try:
+                os.remove(pii)
+                size-=sizeii
+            except OSError:
+                pass
+
+        self.size=size
+        self.added=0
+
@@ -0,0 +1,368 @@
+'''
+SQL statements of the export, and how they are executed.
+
+The statements are constants with "?" parameters, so a query has the same
+SQL text each time it is run, and the statement cache of the sqlite3
+module compiles it once per connection, not once per call. Lists of ids
+in "IN (...)" are padded to a few fixed lengths for the same reason.
+
+Connections made by dbconn.connectDb() are Connection objs: they keep a
+cursor to execute the statements, and the Schema of the database,
+detected once when connected.
+'''
+import sqlite3
+
+# lengths of "IN (...)" lists. A list of ids is split into chunks of the
+# largest length, and each chunk padded to the next length by repeating an
+# id. sqlite limits the number of host parameters in a statement (999 by
+# default).
+IN_SIZES=[1,10,100,500]
+IN_MARKS=dict([(sii,', '.join(['?',]*sii)) for sii in IN_SIZES])
+
+
+#-------------------------Profiles-------------------------
+USER_NAME=\
+'''SELECT Profiles.firstName, Profiles.lastName
+FROM Profiles WHERE Profiles.isSelf="true"
+'''
+
+USER_NAME_FALLBACK=\
+'''SELECT Profiles.firstName, Profiles.lastName
+FROM Profiles
+'''
+
+PROFILE_NAMES=\
+'''SELECT Profiles.uuid,
+          Profiles.firstName,
+          Profiles.lastName
+        FROM Profiles
+'''
+
+#-------------------------Documents-------------------------
+DOC_IDS=\
+'''SELECT Documents.id
+   FROM Documents
+   ORDER BY Documents.id
+'''
+
+TRASHED_DOCS=\
+'''SELECT Documents.id
+   FROM Documents
+   WHERE (Documents.deletionPending="true")
+'''
+
+# columns and a condition on Documents.id to fill in
+DOC_FIELDS=\
+'''SELECT %s
+   FROM Documents
+   WHERE (%s)
+'''
+
+DOC_TAGS=\
+'''SELECT DocumentTags.documentId,
+          DocumentTags.tag
+   FROM DocumentTags
+   WHERE (%s)
+'''
+
+DOC_CONTRIBUTORS=\
+'''SELECT DocumentContributors.documentId,
+          DocumentContributors.firstNames,
+          DocumentContributors.lastName
+   FROM DocumentContributors
+   WHERE (%s)
+'''
+
+DOC_KEYWORDS=\
+'''SELECT DocumentKeywords.documentId,
+          DocumentKeywords.keyword
+   FROM DocumentKeywords
+   WHERE (%s)
+'''
+
+DOC_FOLDERS=\
+'''SELECT DocumentFolders.documentId,
+          Folders.name
+   FROM Folders
+   LEFT JOIN DocumentFolders
+       ON Folders.id=DocumentFolders.folderid
+   WHERE (%s)
+'''
+
+#---------------------------Files---------------------------
+FILE_PATHS=\
+'''SELECT DocumentFiles.documentId,
+          Files.localUrl
+   FROM Files
+   JOIN DocumentFiles
+       ON DocumentFiles.hash=Files.hash
+   WHERE (%s)
+'''
+
+FILE_HASHES=\
+'''SELECT Files.localUrl, Files.hash
+   FROM Files
+   JOIN DocumentFiles
+       ON DocumentFiles.hash=Files.hash
+   WHERE (%s)
+'''
+
+#------------------------Annotations------------------------
+# For Mendeley versions newer than 1.16.1 (include), with highlight colors
+HIGHLIGHTS=\
+'''SELECT Files.localUrl, FileHighlightRects.page,
+                FileHighlightRects.x1, FileHighlightRects.y1,
+                FileHighlightRects.x2, FileHighlightRects.y2,
+                FileHighlights.createdTime,
+                FileHighlights.author,
+                FileHighlights.profileUuid,
+                FileHighlights.color,
+                FileHighlights.documentId
+        FROM Files
+        JOIN FileHighlights
+            ON FileHighlights.fileHash=Files.hash
+        JOIN FileHighlightRects
+            ON FileHighlightRects.highlightId=FileHighlights.id
+        WHERE (FileHighlightRects.page IS NOT NULL) AND
+        (%s)
+'''
+
+# For Mendeley versions older than 1.16.1, no highlight colors
+HIGHLIGHTS_NO_COLOR=\
+'''SELECT Files.localUrl, FileHighlightRects.page,
+                FileHighlightRects.x1, FileHighlightRects.y1,
+                FileHighlightRects.x2, FileHighlightRects.y2,
+                FileHighlights.createdTime,
+                FileHighlights.author,
+                FileHighlights.profileUuid,
+                FileHighlights.documentId
+        FROM Files
+        JOIN FileHighlights
+            ON FileHighlights.fileHash=Files.hash
+        JOIN FileHighlightRects
+            ON FileHighlightRects.highlightId=FileHighlights.id
+        WHERE (FileHighlightRects.page IS NOT NULL) AND
+        (%s)
+'''
+
+NOTES=\
+'''SELECT Files.localUrl, FileNotes.page,
+                FileNotes.x, FileNotes.y,
+                FileNotes.note,
+                FileNotes.modifiedTime,
+                FileNotes.author,
+                FileNotes.profileUuid,
+                FileNotes.documentId
+        FROM Files
+        JOIN FileNotes
+            ON FileNotes.fileHash=Files.hash
+        WHERE (FileNotes.page IS NOT NULL) AND
+        (%s)
+'''
+
+# Some versions of Mendeley saves notes in DocumentsNotes
+DOC_NOTES=\
+'''SELECT DocumentNotes.text,
+          DocumentNotes.documentId,
+          DocumentNotes.baseNote
+        FROM DocumentNotes
+        WHERE (DocumentNotes.documentId IS NOT NULL) AND
+        (%s)
+'''
+
+# Some versions (not sure which exactly) of Mendeley saves
+# notes in Documents.note
+DOC_NOTE_FIELD=\
+'''SELECT Documents.note,
+          Documents.id
+        FROM Documents
+        WHERE (Documents.note IS NOT NULL) AND
+        (%s)
+'''
+
+#--------------------------Folders--------------------------
+FOLDER_IDS=\
+'''SELECT Folders.id
+   FROM Folders
+'''
+
+FOLDERS=\
+'''SELECT Folders.id,
+          Folders.name,
+          Folders.parentID
+   FROM Folders
+'''
+
+FOLDER_COUNTS=\
+'''SELECT DocumentFolders.folderId,
+          COUNT(*)
+   FROM DocumentFolders
+   JOIN Documents
+       ON Documents.id=DocumentFolders.documentId
+   GROUP BY DocumentFolders.folderId
+'''
+
+FOLDER_DOCS=\
+'''SELECT Documents.id
+   FROM Documents
+   JOIN DocumentFolders
+       ON Documents.id=DocumentFolders.documentId
+   WHERE (DocumentFolders.folderid=?)
+'''
+
+CANONICAL_DOCS=\
+'''SELECT Documents.id
+   FROM Documents
+   LEFT JOIN DocumentFolders
+       ON DocumentFolders.documentId=Documents.id
+   WHERE (DocumentFolders.folderId IS NULL)
+'''
+
+
+
+class Schema(object):
+
+    def __init__(self,db):
+        '''Tables and columns of a database
+
+        <db>: sqlite3.Connection obj.
+
+        Mendeley versions differ in some tables and columns, e.g.
+        FileHighlights.color is new in 1.16.1. Queries check them here,
+        instead of trying a statement and falling back if it fails.
+        '''
+
+        query=\
+        '''SELECT name FROM sqlite_master
+           WHERE type="table"
+        '''
+
+        # key: table name, value: set of column names. Names in lower case,
+        # as sqlite names are case insensitive.
+        self.columns={}
+        for tableii, in db.execute(query).fetchall():
+            self.columns[tableii.lower()]=set([rowjj[1].lower() for rowjj in\
+                    db.execute('PRAGMA table_info("%s")' %tableii)])
+
+    def hasColumns(self,table,columns):
+        '''Check if a table exists and has all of <columns>'''
+
+        existing=self.columns.get(table.lower())
+        return existing is not None and\
+                all([cii.lower() in existing for cii in columns])
+
+
+class Connection(sqlite3.Connection):
+
+    def __init__(self,*args,**kwargs):
+        '''sqlite3 connection reusing one cursor, and with the db schema
+
+        Created with sqlite3.connect(path,factory=Connection). <schema>
+        is set by dbconn.connectDb() once the database is ready.
+        '''
+
+        sqlite3.Connection.__init__(self,*args,**kwargs)
+        self.schema=None
+        self._cursor=None
+
+    def fetch(self,sql,params=()):
+        '''Execute a statement and return all rows, see fetch()'''
+
+        if self._cursor is None:
+            self._cursor=self.cursor()
+        return self._cursor.execute(sql,params).fetchall()
+
+
+def getSchema(db):
+    '''Get Schema of a connection, detected if not done at connect time'''
+
+    schema=getattr(db,'schema',None)
+    if schema is None:
+        schema=Schema(db)
+    return schema
+
+
+def fetch(db,sql,params=()):
+    '''Execute a statement and return all rows
+
+    <db>: sqlite3.Connection obj. A Connection obj executes on its cached
+          cursor.
+    <sql>: str, statement, e.g. one of the constants in this module.
+    <params>: sequence, values of the "?" parameters in <sql>.
+
+    Return <rows>: list of tuples.
+
+    Rows are fetched at once, so the cursor can be reused by the next
+    statement.
+    '''
+
+    if isinstance(db,Connection):
+        return db.fetch(sql,params)
+    return db.execute(sql,params).fetchall()
+
+
+_STATEMENTS={}
+
+def getStatement(sql,*args):
+    '''Fill the "%s" fields of a statement, e.g. a docFilter() condition
+
+    Statements are cached, so the same fields give the same SQL text.
+    '''
+
+    key=(sql,)+args
+    if key not in _STATEMENTS:
+        _STATEMENTS[key]=sql %args
+    return _STATEMENTS[key]
+
+
+def docFilter(column,filterdocid):
+    '''Get sql conditions to select documents by id.
+
+    <column>: str, column of document ids to filter on.
+    <filterdocid>: int, id of a document. Or a list of ints, ids of documents.
+                   Or None, select all documents.
+
+    Return: generator of (condition, parameters) tuples. A list of ids is
+            split into chunks, one condition for each. Chunks are padded
+            to one of IN_SIZES, so there are only a few distinct conditions.
+    '''
+
+    if filterdocid is None:
+        yield '1',[]
+        return
+
+    if isinstance(filterdocid,(list,tuple,set)):
+        ids=list(set(filterdocid))
+    else:
+        ids=[filterdocid,]
+
+    maxsize=IN_SIZES[-1]
+    for ii in range(0,len(ids),maxsize):
+        idsii=ids[ii:ii+maxsize]
+        for sizejj in IN_SIZES:
+            if sizejj>=len(idsii):
+                break
+        idsii.extend(idsii[-1:]*(sizejj-len(idsii)))
+        yield getStatement('%s IN (%s)',column,IN_MARKS[sizejj]),idsii
+
+
+def fetchDocs(db,sql,column,filterdocid,*args):
+    '''Execute a statement on documents selected by id
+
+    <sql>: str, statement whose last "%s" field is a condition on
+           <column>, the others are filled by <args>.
+    <column>, <filterdocid>: see docFilter().
+
+    Return: generator of tuples, rows of all chunks of ids.
+
+    Rows are read from the cursor as they are iterated, so all the rows,
+    e.g. of the whole library if <filterdocid> is None, are never in
+    memory at once. The statement runs on a new cursor, so others can be
+    executed (e.g. by fetch()) in the middle of the iteration.
+    '''
+
+    cursor=db.cursor()
+    for condii,paramsii in docFilter(column,filterdocid):
+        for rowjj in cursor.execute(getStatement(sql,*(args+(condii,))),\
+                paramsii):
+            yield rowjj
@@ -6,6 +6,12 @@ Update time: 2018-08-06 21:43:20.
 '''
 import os
 import re
+import shutil
+import itertools
+from collections import OrderedDict
+
+# number of docs in a chunk formatted by a pool worker, see formatDocs()
+POOL_CHUNK_SIZE=20
 
 
 
@@ -236,6 +242,141 @@ def saveFile(abpath_out,text,overwrite=True,verbose=True):
         
 
 
+class OutputWriter(object):
+
+    def __init__(self,resume=False,bufsize=1024**2,log=None):
+        '''Write entries to output files, through buffered tmp files
+
+        <resume>: bool, if True, continue writing to tmp files left by an
+                  interrupted export, which are rolled back to the last
+                  checkpoint. Otherwise tmp files left are discarded.
+        <bufsize>: int, entries are buffered in memory up to this number
+                   of bytes for each file.
+        <log>: function or None, called with the path of each file before
+               first written to, e.g. menotexport.Journal.record().
+
+        Entries are appended to a tmp file next to the output file, which
+        starts as a copy of the output file if one exists. One handle is
+        kept open for each file until close(), which renames the tmp file
+        to the output file, so an output file is never half written.
+
+        Paths of the files written, including those written by other
+        functions and recorded by record(), are kept in <outputs>.
+        '''
+
+        self.resume=resume
+        self.bufsize=bufsize
+        self.files={}  # key: output path, value: [handle, entries, size]
+        self.outputs=set()  # paths of output files written
+        self.log=log
+
+    def getTmpPath(self,abpath):
+        return abpath+'.tmp'
+
+    def write(self,abpath,data):
+        '''Append <data> (str) to output file <abpath>'''
+
+        if abpath not in self.files:
+            self.outputs.add(abpath)
+            self.files[abpath]=[self._open(abpath),[],0]
+
+        fileii=self.files[abpath]
+        fileii[1].append(data)
+        fileii[2]+=len(data)
+        if fileii[2]>=self.bufsize:
+            self._flush(fileii)
+
+    def record(self,abpath):
+        '''Record an output file, e.g. a .txt file written by other functions
+
+        Call before writing to the file.
+        '''
+
+        if abpath not in self.outputs:
+            self.outputs.add(abpath)
+            if self.log is not None:
+                self.log(abpath)
+
+    def _open(self,abpath):
+        tmppath=self.getTmpPath(abpath)
+        continued=self.resume and os.path.exists(tmppath)
+        if not continued and os.path.exists(tmppath):
+            os.remove(tmppath)
+        # the output file is only changed in close()
+        if self.log is not None:
+            self.log(tmppath)
+        if not continued and os.path.exists(abpath):
+            shutil.copyfile(abpath,tmppath)
+
+        return open(tmppath,mode='a')
+
+    def _flush(self,fileii):
+        fout,entries,size=fileii
+        if len(entries)>0:
+            fout.write(''.join(entries))
+            fileii[1]=[]
+            fileii[2]=0
+        fout.flush()
+
+    def flush(self):
+        '''Write buffered entries to tmp files, e.g. before a checkpoint'''
+
+        for fileii in self.files.values():
+            self._flush(fileii)
+
+    def close(self,folder=None):
+        '''Finish output files, and move them into place
+
+        <folder>: str or None, if given, only finish files in <folder>.
+                  Otherwise finish all files.
+        '''
+
+        for abpath in list(self.files.keys()):
+            if folder is not None and os.path.normpath(\
+                    os.path.dirname(abpath))!=os.path.normpath(folder):
+                continue
+
+            fileii=self.files.pop(abpath)
+            self._flush(fileii)
+            fileii[0].close()
+            tmppath=self.getTmpPath(abpath)
+            if os.name=='nt' and os.path.exists(abpath):
+                os.remove(abpath)
+            os.rename(tmppath,abpath)
+            # finished now, not when last written to
+            os.utime(abpath,None)
+
+
+def formatDocs(func,doclist,args,pool=None,size=POOL_CHUNK_SIZE):
+    '''Format entries of docs in chunks, in parallel if given a pool
+
+    <func>: function, called with a tuple (chunk of <doclist>,)+<args>,
+            returns a list of the entry str of each doc, or None if failed.
+            Defined at module level, to be run in pool workers.
+    <doclist>: list of meta data dicts.
+    <args>: tuple, other arguments of <func>.
+    <pool>: multiprocessing.Pool obj or None, pool to format chunks in
+            parallel.
+    <size>: int, number of docs in a chunk.
+
+    Return: generator of (doc, entry) tuples, in the order of <doclist>.
+    '''
+
+    chunks=[doclist[ii:ii+size] for ii in range(0,len(doclist),size)]
+    if pool is not None and len(chunks)>1:
+        # fields are written in the iteration order of the meta dicts, keep
+        # the order when they are copied to workers
+        tasks=[([OrderedDict(docjj.items()) for docjj in chunkii],)+args\
+                for chunkii in chunks]
+        results=pool.imap(func,tasks)
+    else:
+        results=itertools.imap(func,[(chunkii,)+args for chunkii in chunks])
+
+    for chunkii,resultsii in itertools.izip(chunks,results):
+        for docjj,entryjj in zip(chunkii,resultsii):
+            yield docjj,entryjj
+
+
 def makedirs(path):
     '''Make dir and remove invalid windows path characters
 
@@ -0,0 +1,180 @@
+'''
+Run tasks in isolated worker processes, with time and memory limits.
+
+A malformed PDF can make pdfminer spin for hours or use up all memory.
+Each task is run in its own process, which is killed if it runs longer
+than a timeout or uses more memory than a limit, so one bad file can't
+stall the other ones.
+'''
+import os
+import time
+import multiprocessing
+
+POLL_INTERVAL=0.05  # in seconds
+
+try:
+    PAGE_SIZE=os.sysconf('SC_PAGE_SIZE')
+except:
+    PAGE_SIZE=4096
+
+
+class WorkerFailure(object):
+
+    def __init__(self,reason):
+        '''Result of a task whose worker process was killed or died.
+
+        <reason>: str, why the task failed.
+        '''
+        self.reason=reason
+
+    def __repr__(self):
+        return 'WorkerFailure(%r)' %self.reason
+
+
+def getRss(pid):
+    '''Get private resident memory of a process
+
+    Return <rss>: int or None, in bytes. None if not available, which is
+                  the case on systems without /proc.
+
+    Pages shared with other processes, e.g. copy-on-write pages a worker
+    shares with the main process it is forked from, are not counted.
+    Where /proc/<pid>/smaps_rollup is missing (Linux<4.14), file-backed
+    shared pages are subtracted from the resident ones, which still
+    counts shared anonymous pages.
+    '''
+
+    try:
+        rss=0
+        with open('/proc/%d/smaps_rollup' %pid) as fin:
+            for lineii in fin:
+                if lineii.startswith('Private_Clean:') or\
+                        lineii.startswith('Private_Dirty:'):
+                    rss+=int(lineii.split()[1])*1024
+        return rss
+    except:
+        pass
+
+    try:
+        with open('/proc/%d/statm' %pid) as fin:
+            fields=fin.read().split()
+        return (int(fields[1])-int(fields[2]))*PAGE_SIZE
+    except:
+        return None
+
+
+def _runTask(conn,func,args):
+    conn.send(func(args))
+    conn.close()
+
+
+class IsolatedPool(object):
+
+    def __init__(self,processes=1,timeout=None,maxrss=None):
+        '''Pool running each task in a new process
+
+        <processes>: int, max number of tasks running at the same time.
+        <timeout>: float or None, seconds a task can run before killed.
+        <maxrss>: int or None, resident memory in bytes a task can use
+                  before killed, not including memory shared with the
+                  main process, see getRss(). Only works where getRss()
+                  works.
+
+        Works like multiprocessing.Pool.imap(), for the tasks of
+        menotexport.extractAnnos().
+        '''
+
+        self.processes=max(1,processes or 1)
+        self.timeout=timeout
+        self.maxrss=maxrss
+
+    def imap(self,func,tasks):
+        '''Run func(task) for each of <tasks> in worker processes
+
+        Yield <result>: return value of func(task), or a WorkerFailure obj
+                        if the worker is killed or dies. In the same order
+                        as <tasks>.
+        '''
+
+        tasks=list(tasks)
+        results={}
+        running=[]   # [task index, process, connection, start time]
+        nextii=0
+
+        try:
+            for ii in range(len(tasks)):
+                while ii not in results:
+                    while nextii<len(tasks) and len(running)<self.processes:
+                        running.append(self._start(nextii,func,tasks[nextii]))
+                        nextii+=1
+                    self._check(running,results)
+                yield results.pop(ii)
+        finally:
+            for idxii,procii,connii,startii in running:
+                procii.terminate()
+                procii.join()
+                connii.close()
+
+    def _start(self,idx,func,task):
+        conn_in,conn_out=multiprocessing.Pipe(False)
+        proc=multiprocessing.Process(target=_runTask,args=(conn_out,func,task))
+        proc.daemon=True
+        proc.start()
+        conn_out.close()
+
+        return [idx,proc,conn_in,time.time()]
+
+    def _check(self,running,results):
+        '''Check running workers once, and collect results of those done'''
+
+        done=[]
+        for workerii in running:
+            idxii,procii,connii,startii=workerii
+            result=None
+
+            # check if alive before poll, so data sent right before exit
+            # are not missed
+            alive=procii.is_alive()
+            if connii.poll():
+                try:
+                    result=connii.recv()
+                except (EOFError,IOError):
+                    procii.join()
+                    result=WorkerFailure('worker exited with code %s'\
+                            %procii.exitcode)
+            elif not alive:
+                procii.join()
+                result=WorkerFailure('worker exited with code %s'\
+                        %procii.exitcode)
+            elif self.timeout is not None and\
+                    time.time()-startii>self.timeout:
+                procii.terminate()
+                result=WorkerFailure('timed out after %g s' %self.timeout)
+            elif self.maxrss is not None:
+                rss=getRss(procii.pid)
+                if rss is not None and rss>self.maxrss:
+                    procii.terminate()
+                    result=WorkerFailure('used more than %g Mb memory'\
+                            %(self.maxrss/1024.**2))
+
+            if result is not None:
+                procii.join()
+                connii.close()
+                results[idxii]=result
+                done.append(workerii)
+
+        for workerii in done:
+            running.remove(workerii)
+        if len(done)==0:
+            time.sleep(POLL_INTERVAL)
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        # workers are killed when imap() is left
+        pass
+
+    def join(self):
+        pass
+
@@ -33,6 +33,7 @@ import tkMessageBox
 import menotexport
 import Queue
 import threading
+import multiprocessing
 import sqlite3
 if sys.version_info[0]>=3:
     import tkinter as tk
@@ -322,6 +323,14 @@ C:\Users\Your_name\AppData\Local\Mendeley Ltd\Mendeley Desktop\your_email@www.me
         self.foldersmenu.current(0)
         self.foldersmenu.bind('<<ComboboxSelected>>',self.setfolder)
         self.foldersmenu.pack(side=tk.LEFT,padx=8)
+
+        #-------------------Number of processes-------------------
+        jobslabel=tk.Label(subframe,text='Processes:',\
+                bg='#bbb')
+        jobslabel.pack(side=tk.LEFT, padx=8)
+
+        self.jobs_spin=tk.Spinbox(subframe,from_=1,to=64,width=3)
+        self.jobs_spin.pack(side=tk.LEFT,padx=8)
         
         #-------------------Quit button-------------------
         quit_button=tk.Button(subframe,text='Quit',\
@@ -486,6 +495,10 @@ C:\Users\Your_name\AppData\Local\Mendeley Ltd\Mendeley Desktop\your_email@www.me
             iszotero=False
         if self.iscustomtemp.get()==1:
             action.append('t')
+        try:
+            jobs=max(1,int(self.jobs_spin.get()))
+        except:
+            jobs=1
 
             
         if 'p' in action or 'm' in action or 'n' in action or 'b' in action or 'r' in action:
@@ -494,6 +507,7 @@ C:\Users\Your_name\AppData\Local\Mendeley Ltd\Mendeley Desktop\your_email@www.me
             self.start_button.configure(state=tk.DISABLED)
             self.help_button.configure(state=tk.DISABLED)
             self.foldersmenu.configure(state=tk.DISABLED)
+            self.jobs_spin.configure(state=tk.DISABLED)
             self.check_export.configure(state=tk.DISABLED)
             self.check_highlight.configure(state=tk.DISABLED)
             self.check_note.configure(state=tk.DISABLED)
@@ -506,7 +520,7 @@ C:\Users\Your_name\AppData\Local\Mendeley Ltd\Mendeley Desktop\your_email@www.me
 
             folder=None if self.menfolder=='All' else folder_sel
 
-            args=[dbfile,outdir,action,folder,separate,iszotero,True]
+            args=[dbfile,outdir,action,folder,separate,iszotero,True,jobs]
 
             self.workthread=WorkThread('work',False,self.stateq)
             self.workthread.deamon=True
@@ -532,6 +546,7 @@ C:\Users\Your_name\AppData\Local\Mendeley Ltd\Mendeley Desktop\your_email@www.me
                     self.start_button.configure(state=tk.NORMAL)
                     self.help_button.configure(state=tk.NORMAL)
                     self.foldersmenu.configure(state='readonly')
+                    self.jobs_spin.configure(state=tk.NORMAL)
                     self.check_export.configure(state=tk.NORMAL)
                     self.check_highlight.configure(state=tk.NORMAL)
                     self.check_note.configure(state=tk.NORMAL)
@@ -587,6 +602,8 @@ def main():
 
 
 if __name__=='__main__':
+    # the frozen exe is re-run by pool workers on windows
+    multiprocessing.freeze_support()
     main()
 
 
@@ -34,8 +34,14 @@ __version__='Menotexport v1.5.1'
 
 #---------------------Imports---------------------
 import sys,os
+import time
+import ast
+import math
+import hashlib
+import cPickle as pickle
 import sqlite3
 import argparse
+import multiprocessing
 from lib import extracttags
 from lib import extractnt
 from lib import exportpdf
@@ -43,7 +49,12 @@ from lib import exportannotation
 from lib import export2bib
 from lib import export2ris
 from lib import extracthl2
-from lib.tools import printHeader, printInd, printNumHeader, makedirs
+from lib import layoutcache
+from lib import workers
+from lib import dbconn
+from lib import queries
+from lib.tools import printHeader, printInd, printNumHeader, makedirs,\
+        OutputWriter
 #from html2text import html2text
 from bs4 import BeautifulSoup
 from datetime import datetime
@@ -79,16 +90,40 @@ NOTE_EXCLUDE_PATTERNS=[
         DOI_PATTERN,
         ]
 
+# Fields of a doc queried from the Documents table
+META_FIELDS=['id','citationkey','title','issue','pages',\
+        'publication','volume','year','doi','abstract',\
+        'arxivId','chapter','city','country','edition','institution',\
+        'isbn','issn','month','day','publisher','series','type',\
+        'read','favourite']
+
+# Other fields of a doc, in the order they are added by getMetaDataBulk()
+META_EXTRA_FIELDS=['tags','firstnames','lastname','keywords','folder',\
+        'user_name','path']
+
+# File in <outdir> to record an export, for later incremental exports
+MANIFEST_FILE='.menotexport_manifest'
+# number of docs processed at a time in a folder
+BATCH_SIZE=200
+# File in <outdir> to record progress of an export, to resume it
+JOURNAL_FILE='.menotexport_journal'
+# Folder in a folder's output dir to save annotations grouped by tags,
+# if the export can be resumed
+TAGS_SPOOL_DIR='.menotexport_tags'
+
 
 
 
 class DocAnno(object):
-    def __init__(self,docid,meta,highlights=None,notes=None):
+    def __init__(self,docid,meta,highlights=None,notes=None,hashes=None):
         '''Obj to hold annotations (highlights+notes) in a doc.
+
+        <hashes>: dict or None, keys: file paths, values: file hashes.
         '''
 
         self.docid=docid
         self.meta=meta
+        self.failed=False  # True if failed to extract from any file
 
         # Get file paths and names, a doc can have multiple files associated
         self.path=meta['path'] # always a list if not None
@@ -115,20 +150,26 @@ class DocAnno(object):
             metaii=meta.copy()
             metaii['path']=pii
 
-            annoii=FileAnno(docid,metaii,highlights=hlii,notes=ntii)
+            hashii=None if hashes is None else hashes.get(pii,None)
+
+            annoii=FileAnno(docid,metaii,highlights=hlii,notes=ntii,\
+                    filehash=hashii)
             self.file_annos[pii]=annoii
 
 
 class FileAnno(object):
 
-    def __init__(self,docid,meta,highlights=None,notes=None):
+    def __init__(self,docid,meta,highlights=None,notes=None,filehash=None):
         '''Obj to hold annotations (highlights+notes) in a single PDF.
+
+        <filehash>: str or None, hash of the PDF (Files.hash).
         '''
 
         self.docid=docid
         self.meta=meta
         self.highlights=highlights
         self.notes=notes
+        self.hash=filehash
 
         self.path=meta['path'] # a string or None
         if self.path is None:
@@ -158,15 +199,426 @@ class FileAnno(object):
         self.pages.sort()
 
 
+class DocRegistry(object):
+
+    def __init__(self,manifest=None,uses=None,context=None):
+        '''Run-level registry of docs, so that a doc is processed only once.
+
+        <manifest>: dict or None, docs recorded in a previous export,
+                    see getManifest(). If not None, compute signatures
+                    of docs, and reuse texts and PDFs of docs not changed
+                    since the previous export.
+        <uses>: dict or None, keys: docid, values: number of folders the
+                doc is in. If given, a doc is dropped from the registry
+                after its last folder is processed, see release().
+        <context>: RunContext obj or None, profiles of the library. If None,
+                   query them when first needed.
+
+        A doc filed in several folders (or in a folder and its subfolders)
+        is exported once for each folder. The registry keeps the meta-data,
+        raw annotations, extracted texts and annotated PDFs of docs
+        processed in previous folders, for later folders to reuse.
+        '''
+
+        self.meta={}   # key: docid, value: meta-data dict
+        self.annos={}  # key: docid, value: raw annotation dict or None
+        self.texts={}  # key: docid, value: (highlights, notes)
+        self.pdfs={}   # key: PDF path, value: exported PDF path or None
+        self.manifest=manifest
+        self.sigs={}   # key: docid, value: signature of doc
+        self.failed=set() # docids failed in extraction
+        self.uses=uses
+        self.records={} # key: docid, value: manifest record of dropped doc
+        self.context=context
+
+    def getContext(self,db):
+        if self.context is None:
+            self.context=RunContext(db)
+        return self.context
+
+    def getMetaData(self,db,docids):
+        '''Get meta-data of docs, query only those not seen before.
+
+        Return <results>: dict, keys: documentId, values: meta-data dict.
+                          These are copies, as exports add fields to them.
+        '''
+
+        newids=[idii for idii in docids if idii not in self.meta]
+        if len(newids)>0:
+            self.meta.update(getMetaDataBulk(db,newids,self.getContext(db)))
+
+        results={}
+        for idii in docids:
+            results[idii]=_copyMeta(self.meta[idii])
+
+        return results
+
+    def getAnnotations(self,db,docids,ishighlight,isnote):
+        '''Get raw annotations of docs, query only those not seen before.
+
+        Return <results>: dict, see the doc in getHighlights(). Docs without
+                          annotations are not included.
+        '''
+
+        newids=[idii for idii in docids if idii not in self.annos]
+        if len(newids)>0:
+            annos={}
+            context=self.getContext(db)
+            if ishighlight:
+                annos = getHighlights(db,newids,annos,context)
+            if isnote:
+                annos = getNotes(db,newids,annos,context)
+                annos = getDocNotes(db,newids,annos,context)
+            for idii in newids:
+                self.annos[idii]=annos.get(idii,None)
+
+            if self.manifest is not None:
+                self.checkSignatures(db,newids)
+
+        results={}
+        for idii in docids:
+            if self.annos[idii] is not None:
+                results[idii]=dict(self.annos[idii])
+
+        return results
+
+    def checkSignatures(self,db,docids):
+        '''Compute signatures of docs, reuse those not changed
+
+        Texts and exported PDFs of docs with the same signature as in
+        the previous export are put into the registry, so they are not
+        extracted/exported again. Exported PDFs removed or changed since
+        are exported again.
+        '''
+
+        hashes=getFileHashes(db,docids)
+        for idii in docids:
+            sigii=getDocSignature(self.meta[idii],self.annos[idii],hashes)
+            self.sigs[idii]=sigii
+
+            oldii=self.manifest.get(idii,None)
+            if oldii is None or oldii['sig']!=sigii:
+                continue
+            if oldii['texts'] is not None:
+                self.texts[idii]=oldii['texts']
+            for pthjj,(outjj,sizejj) in oldii['pdfs'].items():
+                if os.path.isfile(outjj) and os.path.getsize(outjj)==sizejj:
+                    self.pdfs.setdefault(pthjj,outjj)
+
+    def getManifest(self):
+        '''Get records of docs processed, for later incremental exports
+
+        Return <result>: dict, keys: docid, values: dict of
+                         'sig': str, signature of doc.
+                         'texts': (highlights, notes) or None, extracted texts.
+                         'pdfs': dict, keys: PDF paths, values: (exported
+                                 path, size) tuples.
+        '''
+
+        result=dict(self.records)
+        for idii in self.sigs.keys():
+            if idii not in self.failed:
+                result[idii]=self.getRecord(idii)
+
+        return result
+
+    def getRecord(self,docid):
+        pdfs={}
+        for pthii in self.meta[docid]['path'] or []:
+            outii=self.pdfs.get(pthii,None)
+            if outii is not None and os.path.isfile(outii):
+                pdfs[pthii]=(outii,os.path.getsize(outii))
+
+        return {'sig': self.sigs[docid],
+                'texts': self.texts.get(docid,None),
+                'pdfs': pdfs}
+
+    def release(self,docids):
+        '''Drop docs not in any folder to be processed later
+
+        <docids>: list of ints, ids of docs just processed in a folder.
+
+        Keeps the memory use independent of the size of the library.
+        Docs with signatures are kept as manifest records.
+        '''
+
+        if self.uses is None:
+            return
+
+        for idii in docids:
+            self.uses[idii]=self.uses.get(idii,1)-1
+            if self.uses[idii]>0:
+                continue
+            del self.uses[idii]
+
+            if idii in self.sigs:
+                if idii not in self.failed:
+                    self.records[idii]=self.getRecord(idii)
+                del self.sigs[idii]
+            if idii in self.meta:
+                for pthjj in self.meta[idii]['path'] or []:
+                    self.pdfs.pop(pthjj,None)
+                del self.meta[idii]
+            self.annos.pop(idii,None)
+            self.texts.pop(idii,None)
+
+    def extractAnnos(self,annotations,action,verbose,pool=None,cache=None,
+            method=None):
+        '''Extract texts from docs not extracted before.
+
+        See extractAnnos(). Failed files are only reported the first time.
+        '''
+
+        newannos=dict([(kk,vv) for kk,vv in annotations.items()\
+                if kk not in self.texts])
+        nreuse=len(annotations)-len(newannos)
+        if verbose and nreuse>0:
+            printInd('Reuse annotations of %d docs extracted before.'\
+                    %nreuse,3,prefix='# <Menotexport>:')
+
+        faillist=[]
+        if len(newannos)>0:
+            newannos,faillist=extractAnnos(newannos,action,verbose,pool,\
+                    cache,method)
+            for kk,vv in newannos.items():
+                self.texts[kk]=(vv.highlights,vv.notes)
+                if vv.failed:
+                    self.failed.add(kk)
+
+        annotations2={}
+        for kk,vv in annotations.items():
+            vv.highlights,vv.notes=self.texts[kk]
+            annotations2[kk]=vv
+
+        return annotations2,faillist
+
+
+class Journal(object):
+
+    def __init__(self,outdir,options):
+        '''Checkpoints of an export, to resume it if interrupted.
+
+        <outdir>: str, output folder of the export.
+        <options>: tuple, options of the export. A journal saved with
+                   different options is not resumed.
+
+        A checkpoint is saved to JOURNAL_FILE in <outdir> after each batch
+        of docs, recording folders done, docs done in the current folder,
+        sizes of the files written, and the texts and PDFs of docs needed
+        by later folders. Files are recorded in a log by record() before
+        written to, and only these are rolled back to the last checkpoint
+        when resumed.
+        '''
+
+        self.outdir=outdir
+        self.options=options
+        self.path=os.path.join(outdir,JOURNAL_FILE)
+        self.logpath=self.path+'.log'
+        self.folders=[]    # names of folders done
+        self.current=None  # state of the folder being processed
+        self.written={}    # key: file path, value: size before written to,
+                           # None if not existed
+        self.sizes={}      # key: file path, value: size at last checkpoint
+        self.outputs=[]    # paths of output files, see OutputWriter
+        self.texts={}      # texts of docs in registry, see DocRegistry
+        self.pdfs={}       # exported PDFs in registry, see DocRegistry
+
+    def load(self):
+        '''Load the last checkpoint, and roll back files written after it
+
+        Return <resumed>: bool, True if a checkpoint is loaded.
+        '''
+
+        try:
+            with open(self.path,'rb') as fin:
+                journal=pickle.load(fin)
+        except:
+            return False
+
+        if journal.get('options',None)!=self.options:
+            return False
+
+        for kk in ['folders','current','sizes','outputs','texts','pdfs']:
+            setattr(self,kk,journal[kk])
+
+        #------Roll back files written after the checkpoint------
+        self.written=self.readLog()
+        for pii,sizeii in self.written.items():
+            sizeii=self.sizes.get(pii,sizeii)
+            if not os.path.isfile(pii):
+                continue
+            if sizeii is None:
+                os.remove(pii)
+            elif os.path.getsize(pii)>sizeii:
+                with open(pii,'r+b') as fout:
+                    fout.truncate(sizeii)
+
+        return True
+
+    def start(self):
+        '''Discard the log of an export not resumed
+
+        Call save() after this for the first checkpoint.
+        '''
+
+        if os.path.exists(self.logpath):
+            os.remove(self.logpath)
+
+    def readLog(self):
+        '''Read files recorded by record()
+
+        Return <written>: dict, key: file path, value: size before the
+                          export first wrote to it, None if not existed.
+        '''
+
+        written={}
+        try:
+            with open(self.logpath,'r') as fin:
+                for lineii in fin:
+                    try:
+                        pii,sizeii=ast.literal_eval(lineii)
+                    except:
+                        # line cut by the interruption
+                        continue
+                    written.setdefault(pii,sizeii)
+        except IOError:
+            pass
+
+        return written
+
+    def record(self,abpath):
+        '''Record a file in the log, call before writing to it'''
+
+        if abpath in self.written:
+            return
+
+        size=os.path.getsize(abpath) if os.path.isfile(abpath) else None
+        self.written[abpath]=size
+        with open(self.logpath,'a') as fout:
+            fout.write('%r\n' %((abpath,size),))
+
+    def isDone(self,foldername):
+        return foldername in self.folders
+
+    def getState(self,foldername):
+        '''Get the state of a folder interrupted in the middle
+
+        Return <state>: dict or None, see checkpoint().
+        '''
+
+        if self.current is not None and self.current['folder']==foldername:
+            return self.current
+        return None
+
+    def checkpoint(self,foldername,done,numanno,annofile,tagfiles,\
+            registry,writer):
+        '''Save a checkpoint after a batch of docs in a folder
+
+        <done>: set of ints, ids of docs done in folder.
+        <numanno>: int, number of docs with annotations in these docs.
+        <annofile>: str or None, txt file annotations are appended to.
+        <tagfiles>: dict, spool files of annotations grouped by tags,
+                    see extracttags.TagSpool.
+        <registry>: DocRegistry obj.
+        <writer>: tools.OutputWriter obj.
+        '''
+
+        self.current={'folder': foldername, 'done': set(done),
+                'numanno': numanno, 'annofile': annofile,
+                'tagfiles': dict(tagfiles)}
+        self.save(registry,writer)
+
+    def finishFolder(self,foldername,registry,writer):
+        self.folders.append(foldername)
+        self.current=None
+        self.save(registry,writer)
+
+    def save(self,registry,writer):
+        # only files recorded are checked
+        self.sizes={}
+        for pii in self.written.keys():
+            if os.path.isfile(pii):
+                self.sizes[pii]=os.path.getsize(pii)
+            else:
+                self.sizes[pii]=None
+        self.outputs=sorted(writer.outputs)
+        self.texts=dict(registry.texts)
+        self.pdfs=dict(registry.pdfs)
+
+        journal={'options': self.options, 'folders': self.folders,
+                'current': self.current, 'sizes': self.sizes,
+                'outputs': self.outputs, 'texts': self.texts,
+                'pdfs': self.pdfs}
+
+        if not os.path.isdir(self.outdir):
+            makedirs(self.outdir)
+        # write to a tmp file first, never leave a half written journal
+        tmppath=self.path+'.tmp'
+        with open(tmppath,'wb') as fout:
+            pickle.dump(journal,fout,pickle.HIGHEST_PROTOCOL)
+        if os.name=='nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmppath,self.path)
+
+    def remove(self):
+        for pii in [self.path,self.logpath]:
+            if os.path.exists(pii):
+                os.remove(pii)
+
+
+def getDocSignature(meta,annos,hashes):
+    '''Get a signature of a doc, which changes if the doc changes
+
+    <meta>: dict, meta-data of doc.
+    <annos>: dict or None, raw annotations of doc, see getHighlights().
+    <hashes>: dict, keys: file paths, values: file hashes.
+
+    Return <sig>: str, hash of meta-data, annotations and hashes of files.
+    '''
+
+    items=[sorted(meta.items())]
+
+    for kk in ['highlights','notes']:
+        if annos is None or kk not in annos:
+            continue
+        for pthii,pagesii in sorted(annos[kk].items()):
+            for pgjj,annosjj in sorted(pagesii.items()):
+                for annokk in annosjj:
+                    annokk=dict(annokk)
+                    # creation time of doc notes is the time of query
+                    if annokk.get('isgeneralnote',False):
+                        annokk.pop('cdate',None)
+                    items.append((kk,pthii,pgjj,sorted(annokk.items())))
+
+    for pthii in meta['path'] or []:
+        items.append((pthii,hashes.get(pthii,None)))
+
+    return hashlib.sha1(repr(items)).hexdigest()
+
+
 def convert2datetime(s):
     return datetime.strptime(s,'%Y-%m-%dT%H:%M:%SZ')
 
 
+# key: localUrl, value: absolute path, see converturl2abspath(). Cleared
+# at the start of each run, as files may move between runs.
+_URL_PATHS={}
+
 def converturl2abspath(url):
     '''Convert a url string to an absolute path
     This is necessary for filenames with unicode strings.
+
+    Results are cached, so each url is parsed and stat-ed only once per
+    run, not once for each highlight/note in the file.
     '''
 
+    if url not in _URL_PATHS:
+        _URL_PATHS[url]=_url2abspath(url)
+    return _URL_PATHS[url]
+
+
+def _url2abspath(url):
+
     #--------------------For linux--------------------
     path = unquote(str(urlparse(url).path)).decode("utf8") 
     path=os.path.abspath(path)
@@ -184,223 +636,298 @@ def converturl2abspath(url):
             return path
 
 
+def _chunks(values,size=500):
+    '''Split a list into chunks of at most <size> values.'''
+    for ii in range(0,len(values),size):
+        yield values[ii:ii+size]
+
+
+def _saveToDict(results,docid,key,pth,pg):
+    '''Get the list of annotations in <results>, creating it if needed.
+
+    See the doc in getHighlights() for the structure of <results>.
+    '''
+    return results.setdefault(docid,{}).setdefault(key,{}).\
+            setdefault(pth,{}).setdefault(pg,[])
+
+
 def getUserName(db):
     '''Query db to get user name'''
 
-    query=\
-    '''SELECT Profiles.firstName, Profiles.lastName
-    FROM Profiles WHERE Profiles.isSelf="true"
-    '''
-    query_fallback=\
-    '''SELECT Profiles.firstName, Profiles.lastName
-    FROM Profiles
-    '''
-    ret=db.execute(query).fetchall()
+    ret=queries.fetch(db,queries.USER_NAME)
     if len(ret)==0:
-        ret=db.execute(query_fallback).fetchall()
+        ret=queries.fetch(db,queries.USER_NAME_FALLBACK)
     return ' '.join(filter(None,ret[0]))
 
 
 def getProfileNames(db):
     '''Get user (including co-authors) names'''
 
-    query =\
-    '''SELECT Profiles.uuid,
-              Profiles.firstName,
-              Profiles.lastName
-            FROM Profiles
-    '''
-    ret=db.execute(query).fetchall()
+    ret=queries.fetch(db,queries.PROFILE_NAMES)
     data=dict([(ii[0],' '.join(filter(None,ii[1:]))) for ii in ret])
     return data
 
 
+class RunContext(object):
+
+    def __init__(self,db):
+        '''Data of the library that don't change during a run
+
+        <db>: sqlite3.connection to Mendeley sqlite database.
+
+        Profiles are queried once, for the user name added to meta-data
+        and notes, and for the authors of highlights and notes. So are ids
+        of docs in Trash, to filter the docs of each folder.
+        '''
+
+        self.username=getUserName(db)
+        self.profiles=getProfileNames(db)  # key: uuid, value: name
+        self.trashed=getTrashedDocs(db)    # ids of docs in Trash
+
+    def getProfileName(self,uuid):
+        '''Get name of a profile by uuid, '' if not found'''
+
+        if uuid is None:
+            return ''
+        return self.profiles.get(uuid,'')
+
+
 def getMetaData(db, docid):
     '''Get meta-data of a doc by documentId.
-    '''
 
-    # fetch column from Document table
-    query_base=\
-    '''SELECT Documents.%s
-       FROM Documents
-       WHERE (Documents.id=%s)
+    See getMetaDataBulk().
     '''
 
-    query_tags=\
-    '''
-    SELECT DocumentTags.tag
-    FROM DocumentTags
-    WHERE (DocumentTags.documentId=%s)
-    ''' %docid
+    return getMetaDataBulk(db,[docid,])[docid]
 
-    query_firstnames=\
-    '''
-    SELECT DocumentContributors.firstNames
-    FROM DocumentContributors
-    WHERE (DocumentContributors.documentId=%s)
-    ''' %docid
 
-    query_lastnames=\
-    '''
-    SELECT DocumentContributors.lastName
-    FROM DocumentContributors
-    WHERE (DocumentContributors.documentId=%s)
-    ''' %docid
+def getMetaDataBulk(db, docids, context=None):
+    '''Get meta-data of a list of docs using a few set-based queries.
 
-    query_keywords=\
-    '''
-    SELECT DocumentKeywords.keyword
-    FROM DocumentKeywords
-    WHERE (DocumentKeywords.documentId=%s)
-    ''' %docid
+    <db>: sqlite3.connection to Mendeley sqlite database.
+    <docids>: list of ints, ids of documents to query.
+    <context>: RunContext obj or None, profiles of the library. If None,
+               query them.
+
+    Return: <results>: dict, keys: documentId, values: meta-data dict
+            of the doc.
 
-    query_folder=\
+    Instead of querying each field of each doc separately, fetch the
+    Documents rows in one go, and the tags, authors, keywords, folders
+    and file paths grouped by documentId, so the number of queries
+    grows with the number of tables rather than docs x fields.
     '''
-    SELECT Folders.name
-    FROM Folders
-       LEFT JOIN DocumentFolders
-           ON Folders.id=DocumentFolders.folderid
-    WHERE (DocumentFolders.documentId=%s)
-    ''' %docid
-
-
-    def fetchField(db,query):
-        aa=db.execute(query).fetchall()
-        bb=[ii[0] for ii in aa]
-        if len(bb)==1:
-            return bb[0]
-        elif len(bb)==0:
+
+    def collapse(values):
+        # single value if 1 entry, None if empty, list otherwise
+        if len(values)==1:
+            return values[0]
+        elif len(values)==0:
             return None
         else:
-            return bb
+            return values
 
     #------------------Get file meta data------------------
-    fields=['id','citationkey','title','issue','pages',\
-            'publication','volume','year','doi','abstract',\
-            'arxivId','chapter','city','country','edition','institution',\
-            'isbn','issn','month','day','publisher','series','type',\
-            'read','favourite']
-
-
-    result={}
-
-    # query single-worded fields, e.g. year, city
-    for kii in fields:
-        vii=fetchField(db,query_base %(kii,docid))
-        result[kii]=vii
-
-    result['tags']=fetchField(db,query_tags)
-    result['firstnames']=fetchField(db,query_firstnames)
-    result['lastname']=fetchField(db,query_lastnames)
-    result['keywords']=fetchField(db,query_keywords)
-    result['folder']=fetchField(db,query_folder)
+    fields=META_FIELDS
+
+    docids=list(set(docids))
+    columns=', '.join(['Documents.%s' %kii for kii in fields])
+    docs={}
+    tags={}
+    firstnames={}
+    lastnames={}
+    keywords={}
+    folders={}
+
+    for rii in queries.fetchDocs(db,queries.DOC_FIELDS,'Documents.id',
+            docids,columns):
+        docs[rii[0]]=rii
+
+    for rii in queries.fetchDocs(db,queries.DOC_TAGS,
+            'DocumentTags.documentId',docids):
+        tags.setdefault(rii[0],[]).append(rii[1])
+
+    for rii in queries.fetchDocs(db,queries.DOC_CONTRIBUTORS,
+            'DocumentContributors.documentId',docids):
+        firstnames.setdefault(rii[0],[]).append(rii[1])
+        lastnames.setdefault(rii[0],[]).append(rii[2])
+
+    for rii in queries.fetchDocs(db,queries.DOC_KEYWORDS,
+            'DocumentKeywords.documentId',docids):
+        keywords.setdefault(rii[0],[]).append(rii[1])
+
+    for rii in queries.fetchDocs(db,queries.DOC_FOLDERS,
+            'DocumentFolders.documentId',docids):
+        folders.setdefault(rii[0],[]).append(rii[1])
 
     #-----------------Append user name-----------------
-    result['user_name']=getUserName(db)
+    if context is None:
+        context=RunContext(db)
+    user_name=context.username
 
     #------------------Add local url------------------
-    result['path']=getFilePath(db,docid)  # None or list
-
-    #-----Add folder to tags, if not there already-----
-    folder=result['folder']
-    result['folder']=folder or 'Canonical' # if no folder name, a canonical doc
-    tags=result['tags']
-    tags=tags or []
-    # Now I decide not to do this
-    '''
-    if folder is not None:
-        if tags is None:
-            if isinstance(folder,list):
-                tags=folder
+    paths=getFilePaths(db,docids)
+
+    results={}
+    for idii in docids:
+        rowii=docs.get(idii,(None,)*len(fields))
+        result=dict(zip(fields,rowii))
+
+        result['tags']=collapse(tags.get(idii,[]))
+        result['firstnames']=collapse(firstnames.get(idii,[]))
+        result['lastname']=collapse(lastnames.get(idii,[]))
+        result['keywords']=collapse(keywords.get(idii,[]))
+        result['folder']=collapse(folders.get(idii,[]))
+        result['user_name']=user_name
+        result['path']=paths[idii]  # None or list
+
+        #-----Add folder to tags, if not there already-----
+        folder=result['folder']
+        result['folder']=folder or 'Canonical' # if no folder name, a canonical doc
+        tagsii=result['tags']
+        tagsii=tagsii or []
+        # Now I decide not to do this
+        '''
+        if folder is not None:
+            if tagsii is None:
+                if isinstance(folder,list):
+                    tagsii=folder
+                else:
+                    tagsii=[folder,]
+            elif isinstance(tagsii,list) and isinstance(folder,list):
+                tagsii.extend(folder)
+                tagsii=list(set(tagsii))
+            elif isinstance(tagsii,list) and not isinstance(folder,list):
+                tagsii.append(folder)
+                tagsii=list(set(tagsii))
+            elif not isinstance(tagsii,list) and isinstance(folder,list):
+                tagsii=folder+[tagsii,]
+                tagsii=list(set(tagsii))
+            elif not isinstance(tagsii,list) and not isinstance(folder,list):
+                tagsii=[tagsii, folder]
+                tagsii=list(set(tagsii))
             else:
-                tags=[folder,]
-        elif isinstance(tags,list) and isinstance(folder,list):
-            tags.extend(folder)
-            tags=list(set(tags))
-        elif isinstance(tags,list) and not isinstance(folder,list):
-            tags.append(folder)
-            tags=list(set(tags))
-        elif not isinstance(tags,list) and isinstance(folder,list):
-            tags=folder+[tags,]
-            tags=list(set(tags))
-        elif not isinstance(tags,list) and not isinstance(folder,list):
-            tags=[tags, folder]
-            tags=list(set(tags))
+                # there shouldn't be anything else, should it?
+                #pass
+                tagsii=[]
         else:
-            # there shouldn't be anything else, should it?
-            #pass
-            tags=[]
-    else:
-        tags=tags or []
-    '''
+            tagsii=tagsii or []
+        '''
+
+        if not isinstance(tagsii,list):
+            tagsii=[tagsii,]
+        tagsii.sort()
+
+        result['tags']=tagsii
+        results[idii]=result
+
+    return results
 
-    if not isinstance(tags,list):
-        tags=[tags,]
-    tags.sort()
 
-    result['tags']=tags
+def _copyMeta(meta):
+    '''Copy a meta-data dict, and the lists in it
+
+    Keys are inserted in the same order as getMetaDataBulk() does, so that
+    iterating the copy (e.g. when writing .bib entries) gives the same
+    field order as the original.
+    '''
+
+    result={}
+    for kk in META_FIELDS+META_EXTRA_FIELDS+meta.keys():
+        if kk in meta and kk not in result:
+            vv=meta[kk]
+            result[kk]=list(vv) if isinstance(vv,list) else vv
 
     return result
 
 
-def removeTrashedDocs(db, docids):
+def getTrashedDocs(db):
+    '''Get ids of docs that are in Trash.
+
+    Return <results>: set of ints, ids of docs.
+    '''
+
+    return set([ii[0] for ii in queries.fetch(db,queries.TRASHED_DOCS)])
+
+
+def removeTrashedDocs(db, docids, context=None):
     '''Remove ids of docs that are in Trash.
 
+    <context>: RunContext obj or None, with ids of trashed docs. If None,
+               query them.
+
     Ids of trashed docs will still appear in a folder, and will lead to
     duplicates in the export.
     '''
 
-    query_delete=\
+    if context is None:
+        trashed=getTrashedDocs(db)
+    else:
+        trashed=context.trashed
+
+    return [idii for idii in docids if idii not in trashed]
+
+
+#---------------Get file path of PDF(s) using documentId---------------
+def getFilePath(db,docid,verbose=True):
+    '''Get file path of PDF(s) using documentId
+
+    Return <pth>: None or a LIST of file paths. If a single path, a len-1 list.
     '''
-    SELECT Documents.deletionPending
-    FROM Documents
-    WHERE (Documents.id=%s)
+
+    return getFilePaths(db,[docid,])[docid]
+
+
+def getFilePaths(db,docids,verbose=True):
+    '''Get file paths of PDF(s) of a list of docs
+
+    <docids>: list of ints, ids of documents to query.
+
+    Return <results>: dict, keys: documentId, values: None or a LIST of
+                      file paths, see getFilePath().
     '''
 
-    results=[]
+    results=dict([(idii,None) for idii in docids])
 
-    for idii in docids:
-        is_del=db.execute(query_delete %idii).fetchall()[0][0]
-        if not is_del=='true':
-            results.append(idii)
+    for rii in queries.fetchDocs(db,queries.FILE_PATHS,
+            'DocumentFiles.documentId',docids):
+        pthii=converturl2abspath(rii[1])
+        if results[rii[0]] is None:
+            results[rii[0]]=[pthii,]
+        else:
+            results[rii[0]].append(pthii)
 
     return results
 
 
-#---------------Get file path of PDF(s) using documentId---------------
-def getFilePath(db,docid,verbose=True):
-    '''Get file path of PDF(s) using documentId
+def getFileHashes(db,docids):
+    '''Get hashes of PDF(s) of a list of docs
 
-    Return <pth>: None or a LIST of file paths. If a single path, a len-1 list.
+    <docids>: list of ints, ids of documents to query.
+
+    Return <results>: dict, keys: file paths, values: file hashes.
     '''
 
-    query=\
-    '''SELECT Files.localUrl
-       FROM Files
-       LEFT JOIN DocumentFiles
-           ON DocumentFiles.hash=Files.hash
-       LEFT JOIN Documents
-           ON Documents.id=DocumentFiles.documentId
-       WHERE (Documents.id=%s)
-    ''' %docid
+    results={}
+    for rii in queries.fetchDocs(db,queries.FILE_HASHES,
+            'DocumentFiles.documentId',docids):
+        results[converturl2abspath(rii[0])]=rii[1]
 
-    ret=db.execute(query)
-    data=ret.fetchall()
-    if len(data)==0:
-        return None
-    else:
-        pth=[converturl2abspath(urlii[0]) for urlii in data]
-        return pth
+    return results
 
 
 #----------Extract highlights coordinates and related meta data-------
-def getHighlights(db,filterdocid,results=None):
+def getHighlights(db,filterdocid,results=None,context=None):
     '''Extract highlights coordinates and related meta data.
 
     <db>: sqlite3.connection to Mendeley sqlite database.
-    <filterdocid>: int, id of document to query.
+    <filterdocid>: int, id of document to query. Or a list of ints, ids
+                   of documents to query. Or None, query all documents
+                   in the library.
     <results>: dict or None, optional dictionary to hold the results. If None,
                create a new empty dict.
+    <context>: RunContext obj or None, profiles to get names of highlight
+               authors from. If None, query them.
 
     Return: <results>: dictionary containing the query results, with
             the following structure:
@@ -445,59 +972,29 @@ def getHighlights(db,filterdocid,results=None):
     Update time: 2018-07-28 20:00:11.
     '''
 
-    # For Mendeley versions newer than 1.16.1 (include), with highlight colors
-    query_new =\
-    '''SELECT Files.localUrl, FileHighlightRects.page,
-                    FileHighlightRects.x1, FileHighlightRects.y1,
-                    FileHighlightRects.x2, FileHighlightRects.y2,
-                    FileHighlights.createdTime,
-                    FileHighlights.author,
-                    Profiles.firstName,
-                    Profiles.lastName,
-                    FileHighlights.color
-            FROM Files
-            LEFT JOIN FileHighlights
-                ON FileHighlights.fileHash=Files.hash
-            LEFT JOIN FileHighlightRects
-                ON FileHighlightRects.highlightId=FileHighlights.id
-            LEFT JOIN Profiles
-                ON Profiles.uuid=FileHighlights.profileUuid
-            WHERE (FileHighlightRects.page IS NOT NULL) AND
-            (FileHighlights.documentId=%s)
-    ''' %filterdocid
-
-    # For Mendeley versions older than 1.16.1, no highlight colors
-    query_old =\
-    '''SELECT Files.localUrl, FileHighlightRects.page,
-                    FileHighlightRects.x1, FileHighlightRects.y1,
-                    FileHighlightRects.x2, FileHighlightRects.y2,
-                    FileHighlights.createdTime,
-                    FileHighlights.author,
-                    Profiles.firstName,
-                    Profiles.lastName
-            FROM Files
-            LEFT JOIN FileHighlights
-                ON FileHighlights.fileHash=Files.hash
-            LEFT JOIN FileHighlightRects
-                ON FileHighlightRects.highlightId=FileHighlights.id
-            LEFT JOIN Profiles
-                ON Profiles.uuid=FileHighlights.profileUuid
-            WHERE (FileHighlightRects.page IS NOT NULL) AND
-            (FileHighlights.documentId=%s)
-    ''' %filterdocid
-
     if results is None:
         results={}
+    if context is None:
+        context=RunContext(db)
 
     #------------------Get highlights------------------
-    try:
-        ret = db.execute(query_new)
-        hascolor=True
-    except:
-        ret = db.execute(query_old)
-        hascolor=False
+    # highlight colors are in Mendeley versions newer than 1.16.1 (include)
+    hascolor=queries.getSchema(db).hasColumns('FileHighlights',['color'])
+    query=queries.HIGHLIGHTS if hascolor else queries.HIGHLIGHTS_NO_COLOR
+    ret=queries.fetchDocs(db,query,'FileHighlights.documentId',filterdocid)
+    _addHighlights(ret,hascolor,results,context)
+
+    return results
+
 
-    for ii,r in enumerate(ret):
+def _addHighlights(ret,hascolor,results,context):
+    '''Parse rows from the query in getHighlights() and save into <results>
+
+    <ret>: iterable of rows, each is added to <results> as it comes.
+    '''
+
+    for r in ret:
+        docid = r[-1]
         pth = converturl2abspath(r[0])
         pg = r[1]
         bbox = [r[2], r[3], r[4], r[5]]
@@ -511,9 +1008,9 @@ def getHighlights(db,filterdocid,results=None):
         # Changes suggested by matteosecli: retrieve author of highlight:
         author=r[7]
         if not author.strip():
-            author=' '.join(filter(None,r[8:10]))
+            author=context.getProfileName(r[8])
 
-        color=r[10] if hascolor else None
+        color=r[9] if hascolor else None
 
         hlight = {'rect': bbox,\
                   'cdate': cdate,\
@@ -524,32 +1021,21 @@ def getHighlights(db,filterdocid,results=None):
                   }
 
         #------------Save to dict------------
-        # any better way of doing this sht?
-        if filterdocid in results:
-            if 'highlights' in results[filterdocid]:
-                if pth in results[filterdocid]['highlights']:
-                    if pg in results[filterdocid]['highlights'][pth]:
-                        results[filterdocid]['highlights'][pth][pg].append(hlight)
-                    else:
-                        results[filterdocid]['highlights'][pth][pg]=[hlight,]
-                else:
-                    results[filterdocid]['highlights'][pth]={pg:[hlight,]}
-            else:
-                results[filterdocid]['highlights']={pth:{pg:[hlight,]}}
-        else:
-            results[filterdocid]={'highlights':{pth:{pg:[hlight,]}}}
+        _saveToDict(results,docid,'highlights',pth,pg).append(hlight)
 
     return results
 
 
 #-------------------Get sticky notes-------------------
-def getNotes(db,filterdocid,results=None):
+def getNotes(db,filterdocid,results=None,context=None):
     '''Extract notes and related meta data
 
     <db>: sqlite3.connection to Mendeley sqlite database.
-    <filterdocid>: int, id of document to query.
+    <filterdocid>: int, id of document to query. Or a list of ints, or None.
+                   See the doc in getHighlights().
     <results>: dict or None, optional dictionary to hold the results. If None,
                create a new empty dict.
+    <context>: RunContext obj or None, see getHighlights().
 
     Return: <results>: dictionary containing the query results. See
             more in the doc of getHighlights()
@@ -559,30 +1045,26 @@ def getNotes(db,filterdocid,results=None):
     Update time: 2018-07-28 20:01:40.
     '''
 
-    query=\
-    '''SELECT Files.localUrl, FileNotes.page,
-                    FileNotes.x, FileNotes.y,
-                    FileNotes.note,
-                    FileNotes.modifiedTime,
-                    FileNotes.author,
-                    Profiles.firstName,
-                    Profiles.lastName
-            FROM Files
-            LEFT JOIN FileNotes
-                ON FileNotes.fileHash=Files.hash
-            LEFT JOIN Profiles
-                ON Profiles.uuid=FileNotes.profileUuid
-            WHERE (FileNotes.page IS NOT NULL) AND
-            (FileNotes.documentId=%s)
-    ''' %filterdocid
-
     if results is None:
         results={}
+    if context is None:
+        context=RunContext(db)
 
     #------------------Get notes------------------
-    ret = db.execute(query)
+    ret=queries.fetchDocs(db,queries.NOTES,'FileNotes.documentId',filterdocid)
+    _addNotes(ret,results,context)
+
+    return results
+
+
+def _addNotes(ret,results,context):
+    '''Parse rows from the query in getNotes() and save into <results>
 
-    for ii,r in enumerate(ret):
+    <ret>: iterable of rows, each is added to <results> as it comes.
+    '''
+
+    for r in ret:
+        docid = r[-1]
         pth = converturl2abspath(r[0])
         pg = r[1]
         bbox = [r[2], r[3], r[2]+30, r[3]+30]
@@ -594,7 +1076,7 @@ def getNotes(db,filterdocid,results=None):
         # Changes suggested by matteosecli: retrieve author of note:
         author=r[6]
         if not author.strip():
-            author=' '.join(filter(None,r[7:9]))
+            author=context.getProfileName(r[7])
 
         note = {'rect': bbox,\
                 'author':author,\
@@ -606,32 +1088,22 @@ def getNotes(db,filterdocid,results=None):
                   }
 
         #------------Save to dict------------
-        if filterdocid in results:
-            if 'notes' in results[filterdocid]:
-                if pth in results[filterdocid]['notes']:
-                    if pg in results[filterdocid]['notes'][pth]:
-                        results[filterdocid]['notes'][pth][pg].append(note)
-                    else:
-                        results[filterdocid]['notes'][pth][pg]=[note,]
-                else:
-                    results[filterdocid]['notes'][pth]={pg:[note,]}
-            else:
-                results[filterdocid]['notes']={pth:{pg:[note,]}}
-        else:
-            results[filterdocid]={'notes':{pth:{pg:[note,]}}}
-
+        _saveToDict(results,docid,'notes',pth,pg).append(note)
 
     return results
 
 
 #-------------------Get side-bar notes-------------------
-def getDocNotes(db,filterdocid,results=None):
+def getDocNotes(db,filterdocid,results=None,context=None):
     '''Extract side-bar notes and related meta data
 
     <db>: sqlite3.connection to Mendeley sqlite database.
-    <filterdocid>: int, id of document to query.
+    <filterdocid>: int, id of document to query. Or a list of ints, or None.
+                   See the doc in getHighlights().
     <results>: dict or None, optional dictionary to hold the results. If None,
                create a new empty dict.
+    <context>: RunContext obj or None, to get the user name from. If None,
+               query it.
 
     Return: <results>: dictionary containing the query results. with
             See the doc in getHighlights().
@@ -641,25 +1113,6 @@ def getDocNotes(db,filterdocid,results=None):
     Update time: 2018-07-28 20:02:10.
     '''
 
-    # Some versions of Mendeley saves notes in DocumentsNotes
-    query=\
-    '''SELECT DocumentNotes.text,
-              DocumentNotes.documentId,
-              DocumentNotes.baseNote
-            FROM DocumentNotes
-            WHERE (DocumentNotes.documentId IS NOT NULL) AND
-            (DocumentNotes.documentId=%s)
-    ''' %filterdocid
-
-    # Some versions (not sure which exactly) of Mendeley saves
-    # notes in Documents.note
-    query2=\
-    '''SELECT Documents.note
-            FROM Documents
-            WHERE (Documents.note IS NOT NULL) AND
-            (Documents.id=%s)
-    ''' %filterdocid
-
     # regex to transform Mendeley's old note formatting to html
     # e.g. <m:bold>Bold</m:bold>  to <bold>Bold</bold>
     pattern=re.compile(r'<(/?)m:(bold|italic|underline|center|left|right|linebreak)(/?)>',
@@ -670,18 +1123,25 @@ def getDocNotes(db,filterdocid,results=None):
         results={}
 
     #------------------Get notes------------------
+    # notes are in DocumentNotes or Documents.note, depending on the
+    # Mendeley version
+    schema=queries.getSchema(db)
     ret=[]
-    try:
-        ret1 = db.execute(query).fetchall()
-        ret.extend(ret1)
-    except:
-        pass
-    try:
-        ret2 = db.execute(query2).fetchall()
-        ret.extend(ret2)
-    except:
-        pass
-    username=getUserName(db)
+    if schema.hasColumns('DocumentNotes',['text','documentId','baseNote']):
+        ret.extend(queries.fetchDocs(db,queries.DOC_NOTES,
+            'DocumentNotes.documentId',filterdocid))
+    if schema.hasColumns('Documents',['note']):
+        ret.extend(queries.fetchDocs(db,queries.DOC_NOTE_FIELD,
+            'Documents.id',filterdocid))
+
+    if len(ret)==0:
+        return results
+
+    if context is None:
+        context=RunContext(db)
+    username=context.username
+    # Try get file paths, a list, could be more than 1, or None
+    paths=getFilePaths(db,list(set([rii[1] for rii in ret])))
 
     for ii,rii in enumerate(ret):
         docnote=rii[0]
@@ -699,7 +1159,7 @@ def getDocNotes(db,filterdocid,results=None):
         if skip:
             continue
 
-        docid=filterdocid
+        docid=rii[1]
         try:
             basenote=rii[2]
         except:
@@ -727,7 +1187,7 @@ def getDocNotes(db,filterdocid,results=None):
 
         # Try get file path
         #pth=getFilePath(db,docid) or '/pseudo_path/%s.pdf' %title
-        pth=getFilePath(db,docid) # a list, could be more than 1, or None
+        pth=paths[docid] # a list, could be more than 1, or None
         # If no attachment, use None as path
         if pth is None:
             # make it compatible with the for loop below
@@ -747,36 +1207,25 @@ def getDocNotes(db,filterdocid,results=None):
         #-------------------Save to dict-------------------
         # if multiple attachments, add to each of them
         for pthii in pth:
-            if docid in results:
-                if 'notes' in results[docid]:
-                    if pthii in results[docid]['notes']:
-                        if pg in results[docid]['notes'][pthii]:
-                            results[docid]['notes'][pthii][pg].insert(0,note)
-                        else:
-                            results[docid]['notes'][pthii][pg]=[note,]
-                    else:
-                        results[docid]['notes'][pthii]={pg:[note,]}
-                else:
-                    results[docid]['notes']={pthii:{pg:[note,]}}
-            else:
-                results[docid]={'notes':{pthii:{pg:[note,]}}}
+            _saveToDict(results,docid,'notes',pthii,pg).insert(0,note)
 
 
     return results
 
 
 #-------------Reformat annotations to a dict of DocAnno objs-------------
-def reformatAnno(annodict):
+def reformatAnno(annodict,hashes=None):
     '''Reformat annotations to a dict of DocAnno objs
 
     <annodict>: dict, annotation dict. See doc in getHighlights().
+    <hashes>: dict or None, keys: file paths, values: file hashes.
     Return <result>: dict, keys: documentId; value: DocAnno objs.
     '''
     result={}
     for kk,vv in annodict.items():
         annoii=DocAnno(kk,vv['meta'],\
             highlights=vv.get('highlights',{}),\
-            notes=vv.get('notes',{}))
+            notes=vv.get('notes',{}),hashes=hashes)
         result[kk]=annoii
 
     return result
@@ -839,16 +1288,7 @@ def getFolderDocList(db,folderid,verbose=True):
     Update time: 2018-07-28 20:11:09.
     '''
 
-    query=\
-    '''SELECT Documents.id
-       FROM Documents
-       LEFT JOIN DocumentFolders
-           ON Documents.id=DocumentFolders.documentId
-       WHERE (DocumentFolders.folderid=%s)
-    ''' %folderid
-
-    ret=db.execute(query)
-    data=ret.fetchall()
+    data=queries.fetch(db,queries.FOLDER_DOCS,(folderid,))
     docids=[ii[0] for ii in data]
     docids.sort()
     return docids
@@ -857,17 +1297,154 @@ def getFolderDocList(db,folderid,verbose=True):
 
 def getCanonicals(db,verbose=True):
 
-    query=\
-    '''SELECT Documents.id
-       FROM Documents
-       LEFT JOIN DocumentFolders
-           ON DocumentFolders.documentId=Documents.id
-       WHERE (DocumentFolders.folderId IS NULL)
+    data=queries.fetch(db,queries.CANONICAL_DOCS)
+    return [int(ii[0]) for ii in data]
+
+
+
+#----------Index a database snapshot for the export----------
+def indexSnapshot(db,verbose=True,samplesize=BATCH_SIZE):
+    '''Create covering indexes on an in-memory database, and report cost
+
+    <db>: sqlite3.Connection obj, to an in-memory snapshot.
+    <verbose>: bool, if False, only create the indexes, without timing.
+    <samplesize>: int, number of docs in the sample lookups.
+
+    The queries of one batch of docs (highlights, notes and file paths)
+    and of one folder doc list are timed before and after creating the
+    indexes, and the time saved is estimated for all batches and folders.
+    Only the queries are timed, not the parsing of rows, as paths of
+    files are cached after the first time.
+
+    Return <saved>: float or None, estimated seconds saved, negative if the
+                    indexes cost more than they save. None if not verbose.
     '''
 
-    ret=db.execute(query)
-    data=ret.fetchall()
-    return [int(ii[0]) for ii in data]
+    if not verbose:
+        dbconn.createIndexes(db)
+        return None
+
+    docids=[ii[0] for ii in queries.fetch(db,queries.DOC_IDS)]
+    sample=docids[:samplesize]
+    folderids=[ii[0] for ii in queries.fetch(db,queries.FOLDER_IDS)]
+
+    hascolor=queries.getSchema(db).hasColumns('FileHighlights',['color'])
+    statements=[
+            (queries.HIGHLIGHTS if hascolor else queries.HIGHLIGHTS_NO_COLOR,
+                'FileHighlights.documentId'),
+            (queries.NOTES,'FileNotes.documentId'),
+            (queries.FILE_PATHS,'DocumentFiles.documentId')]
+
+    def lookups():
+        t0=time.time()
+        for sqlii,columnii in statements:
+            for rowjj in queries.fetchDocs(db,sqlii,columnii,sample):
+                pass
+        t1=time.time()
+        if len(folderids)>0:
+            queries.fetch(db,queries.FOLDER_DOCS,(folderids[0],))
+        return t1-t0,time.time()-t1
+
+    batch0,folder0=lookups()
+    num,build=dbconn.createIndexes(db)
+    batch1,folder1=lookups()
+
+    # per batch lookups are done once per batch, folder ones once per folder
+    nbatches=int(math.ceil(len(docids)/float(max(1,len(sample)))))
+    saved=(batch0-batch1)*nbatches+(folder0-folder1)*len(folderids)-build
+
+    printHeader('Created %d indexes on the database snapshot in %.3f s.'\
+            %(num,build))
+    printInd('Queries of a batch of %d docs: %.3f s before, %.3f s after.'\
+            %(len(sample),batch0,batch1),2)
+    printInd('Doc list of a folder: %.3f s before, %.3f s after.'\
+            %(folder0,folder1),2)
+    printInd('Estimated time saved on %d docs in %d folders, net of index creation: %.3f s.'\
+            %(len(docids),len(folderids),saved),2)
+
+    return saved
+
+
+#--------------Folder tree of the library----------------
+class FolderTree(object):
+
+    def __init__(self,db):
+        '''Folders of the library, with tree structure and doc counts
+
+        <db>: sqlite3.connection to Mendeley sqlite database.
+
+        Built from one scan of Folders and one grouped count of
+        DocumentFolders, instead of querying and walking the parents of
+        each folder separately.
+        '''
+
+        self.ids=[]       # folder ids, in database order
+        self.names={}     # key: folderid, value: folder name
+        self.parents={}   # key: folderid, value: parent id, None for top level
+        self.children={}  # key: folderid, value: list of child folder ids
+        self.paths={}     # key: folderid, value: folder tree str
+
+        for idii,nameii,pidii in queries.fetch(db,queries.FOLDERS):
+            self.ids.append(idii)
+            self.names[idii]=nameii
+            self.parents[idii]=pidii
+
+        for idii in self.ids:
+            pidii=self.parents[idii]
+            if pidii in [-1,0,None] or pidii not in self.names:
+                self.parents[idii]=None
+            else:
+                self.children.setdefault(pidii,[]).append(idii)
+
+        # key: folderid, value: number of docs in folder (not subfolders)
+        self.counts=dict(queries.fetch(db,queries.FOLDER_COUNTS))
+
+    def getIds(self,name):
+        '''Get ids of folders with a given name'''
+
+        return [idii for idii in self.ids if self.names[idii]==name]
+
+    def getSubFolders(self,folderid):
+        '''Get ids of all subfolders of a folder, at all levels
+
+        Return <results>: sorted list of folder ids.
+        '''
+
+        visited=set([folderid])
+        stack=list(self.children.get(folderid,[]))
+        while len(stack)>0:
+            idii=stack.pop()
+            if idii in visited:
+                continue
+            visited.add(idii)
+            stack.extend(self.children.get(idii,[]))
+
+        visited.remove(folderid)
+        return sorted(visited)
+
+    def getPath(self,folderid):
+        '''Get folder tree str of a folder, e.g. test/testsub/testsub2'''
+
+        # go up to the first folder with known path, then fill paths down
+        chain=[]
+        cid=folderid
+        while cid is not None and cid not in self.paths and cid not in chain:
+            chain.append(cid)
+            cid=self.parents[cid]
+
+        for idii in chain[::-1]:
+            pid=self.parents[idii]
+            if pid is None or pid not in self.paths:
+                self.paths[idii]=self.names[idii]
+            else:
+                self.paths[idii]=u'%s/%s' %(self.paths[pid],self.names[idii])
+
+        return self.paths[folderid]
+
+    def isEmpty(self,folderid):
+        '''Check a folder has no docs, not counting its subfolders'''
+
+        return self.counts.get(folderid,0)==0
 
 
 #--------------Get folder id and name list in database----------------
@@ -888,41 +1465,15 @@ def getFolderList(db,folder,verbose=True):
     Update time: 2016-06-16 19:38:15.
     '''
 
-    # get all folders with id, name, parentid
-    query=\
-    '''SELECT Folders.id,
-              Folders.name,
-              Folders.parentID
-       FROM Folders
-    '''
-    # get folder by name
-    query1=\
-    '''SELECT Folders.id,
-              Folders.name,
-              Folders.parentID
-       FROM Folders
-       WHERE (Folders.name="%s")
-    '''%folder
-
-    #-----------------Get all folders-----------------
-    ret=db.execute(query)
-    data=ret.fetchall()
-
-    # dict, key: folderid, value: (folder_name, parent_id)
-    df=dict([(ii[0],ii[1:]) for ii in data])
-
-    allfolderids=[ii[0] for ii in data]
+    tree=FolderTree(db)
 
     #---------------Select target folder---------------
     if folder is None:
-        folderids=allfolderids
+        folderids=tree.ids
     if type(folder) is str:
-        folderids=db.execute(query1).fetchall()
-        folderids=[ii[0] for ii in folderids]
+        folderids=tree.getIds(folder)
     elif isinstance(folder, (tuple,list)):
         # get folder from gui
-        #seldf=df[(df.folderid==folder[0]) & (df.folder==folder[1])]
-        #folderids=fetchField(seldf,'folderid')
         folderids=[folder[0]]
 
     #----------------Get all subfolders----------------
@@ -930,18 +1481,15 @@ def getFolderList(db,folder,verbose=True):
         folderids2=[]
         for ff in folderids:
             folderids2.append(ff)
-            subfs=getSubFolders(df,ff)
-            folderids2.extend(subfs)
+            folderids2.extend(tree.getSubFolders(ff))
     else:
         folderids2=folderids
 
     #---------------Remove empty folders---------------
-    folderids2=[ff for ff in folderids2 if not isFolderEmpty(db,ff)]
+    folderids2=[ff for ff in folderids2 if not tree.isEmpty(ff)]
 
     #---Get names and tree structure of all non-empty folders---
-    folders=[]
-    for ff in folderids2:
-        folders.append(getFolderTree(df,ff))
+    folders=[(ff,tree.getPath(ff)) for ff in folderids2]
 
     #----------------------Return----------------------
     if folder is None:
@@ -954,111 +1502,93 @@ def getFolderList(db,folder,verbose=True):
             return folders
 
 
-#--------------------Check a folder is empty or not--------------------
-def isFolderEmpty(db,folderid,verbose=True):
-    '''Check a folder is empty or not
-    '''
-
-    query=\
-    '''SELECT Documents.title,
-              DocumentFolders.folderid,
-              Folders.name
-       FROM Documents
-       LEFT JOIN DocumentFolders
-           ON Documents.id=DocumentFolders.documentId
-       LEFT JOIN Folders
-           ON Folders.id=DocumentFolders.folderid
-    '''
-
-    fstr='(Folders.id="%s")' %folderid
-    fstr='WHERE '+fstr
-    query=query+' '+fstr
+def extractFileAnnos(args):
+    '''Extract texts of highlights and notes from an attached file.
 
-    ret=db.execute(query)
-    data=ret.fetchall()
-    if len(data)==0:
-        return True
-    else:
-        return False
+    <args>: tuple, (fpath, fanno, action, method, cache):
+            <fpath>: str, path of the PDF.
+            <fanno>: FileAnno obj, annotations in the PDF.
+            <action>: list, actions from cli arguments.
+            <method>: str, method to extract highlights, one of
+                      extracthl2.METHODS.
+            <cache>: LayoutCache obj or None, cache of page layouts.
 
+    Return <hltexts>: list, highlights, extracthl2.Anno objs.
+           <nttexts>: list, notes, extracthl2.Anno objs.
+           <faillist>: list, names of the file if failed.
 
-#-------------------Get subfolders of a given folder-------------------
-def getSubFolders(df,folderid,verbose=True):
-    '''Get subfolders of a given folder
-
-    <df>: dict, key: folderid, value: (folder_name, parent_id).
-    <folderid>: int, folder id
+    Takes a single tuple argument to be used by multiprocessing.Pool.imap().
     '''
 
-    getParentId=lambda df,id: df[id][1]
-    results=[]
-
-    for idii in df:
-        fii,pii=df[idii]
-        cid=idii
-        while True:
-            pid=getParentId(df,cid)
-            if pid==-1 or pid==0:
-                break
-            if pid==folderid:
-                results.append(idii)
-                break
-            else:
-                cid=pid
-
-    results.sort()
-    return results
-
-#-------------Get folder tree structure of a given folder-------------
-def getFolderTree(df,folderid,verbose=True):
-    '''Get folder tree structure of a given folder
+    fpath,fanno,action,method,cache=args
 
-    <df>: dict, key: folderid, value: (folder_name, parent_id).
-    <folderid>: int, folder id
-    '''
+    fname=fanno.filename
+    # When a doc has no attachment, use title instead of filename
+    if fname is None: fname=fanno.meta['title']
 
-    getFolderName=lambda df,id: df[id][0]
-    getParentId=lambda df,id: df[id][1]
+    faillist=[]
+    if 'm' in action:
+        try:
+            hltexts=extracthl2.extractHighlights2(fpath,fanno,method,False,\
+                    cache)
+        except:
+            faillist.append(fname)
+            hltexts=[]
+    else:
+        hltexts=[]
 
-    folder=getFolderName(df,folderid)
+    if 'n' in action:
+        try:
+            nttexts=extractnt.extractNotes(fpath,fanno,False)
+        except:
+            faillist.append(fname)
+            nttexts=[]
+    else:
+        nttexts=[]
 
-    #------------Back track tree structure------------
-    cid=folderid
-    while True:
-        pid=getParentId(df,cid)
-        if pid==-1 or pid==0:
-            break
-        else:
-            pfolder=getFolderName(df,pid)
-            folder=u'%s/%s' %(pfolder,folder)
-        cid=pid
+    #------------Attach ori texts to notes------------
+    nttexts=extractnt.attachRefTextsToNotes(nttexts,hltexts)
 
-    return folderid,folder
+    return hltexts,nttexts,faillist
 
 
-def extractAnnos(annotations,action,verbose):
+def extractAnnos(annotations,action,verbose,pool=None,cache=None,
+        method=None):
     '''Extract texts and attach meta to annotations.
 
     <annotations>: dict, key: docid, value: DocAnno objs.
     <action>: list, actions from cli arguments.
+    <pool>: multiprocessing.Pool or workers.IsolatedPool obj or None.
+            If given, files are processed in parallel by the pool.
+    <cache>: LayoutCache obj or None, cache of page layouts.
+    <method>: str or None, method to extract highlights, see
+              extracthl2.getMethod(). None for 'auto'.
 
     Return <annotations2>: dict, similar structure as <annotations> but
                            with highlight texts extracted.
-           <faillist>: list, paths of failed pdfs.
+           <faillist>: list, paths of failed pdfs. Files killed by an
+                       IsolatedPool are followed by the reason.
     '''
 
-    #------ Check if pdftotext is available--------
-    if extracthl2.checkPdftotext():
-        has_pdftotext=True
-    else:
-        has_pdftotext=False
+    #------ Check if the method is available--------
+    method=extracthl2.getMethod(method or 'auto')
 
     faillist=[]
     annotations2={}  #keys: docid, values: extracted annotations
 
     #-----------Loop through documents---------------
     num=len(annotations)
-    docids=annotations.keys()
+    docids=sorted(annotations.keys())
+
+    # results come back in the same order as <tasks>, with or without pool
+    tasks=[]
+    for idii in docids:
+        for fjj, annojj in annotations[idii].file_annos.items():
+            tasks.append((fjj,annojj,action,method,cache))
+    if pool is None:
+        results=(extractFileAnnos(tii) for tii in tasks)
+    else:
+        results=pool.imap(extractFileAnnos,tasks)
 
     for ii,idii in enumerate(docids):
         annoii=annotations[idii]
@@ -1074,38 +1604,20 @@ def extractAnnos(annotations,action,verbose):
             if verbose:
                 printNumHeader('Processing file:',ii+1,num,3)
                 printInd(fnamejj,4)
-
-            if 'm' in action:
-                try:
-                    if has_pdftotext:
-                        if verbose:
-                            printInd('Retrieving highlights using pdftotext ...',4,prefix='# <Menotexport>:')
-                        hltexts=extracthl2.extractHighlights2(fjj,annojj,
-                                'pdftotext',verbose)
-                    else:
-                        if verbose:
-                            printInd('Retrieving highlights using pdfminer ...',4,prefix='# <Menotexport>:')
-                        hltexts=extracthl2.extractHighlights2(fjj,annojj,
-                                'pdfminer',verbose)
-                except:
-                    faillist.append(fnamejj)
-                    hltexts=[]
-            else:
-                hltexts=[]
-
-            if 'n' in action:
-                if verbose:
+                if 'm' in action:
+                    printInd('Retrieving highlights using %s ...' %method,4,prefix='# <Menotexport>:')
+                if 'n' in action:
                     printInd('Retrieving notes...',4,prefix='# <Menotexport>:')
-                try:
-                    nttexts=extractnt.extractNotes(fjj,annojj,verbose)
-                except:
-                    faillist.append(fnamejj)
-                    nttexts=[]
-            else:
-                nttexts=[]
 
-            #------------Attach ori texts to notes------------
-            nttexts=extractnt.attachRefTextsToNotes(nttexts,hltexts)
+            result=next(results)
+            if isinstance(result,workers.WorkerFailure):
+                hltexts,nttexts=[],[]
+                failjj=['%s (%s)' %(fnamejj,result.reason)]
+            else:
+                hltexts,nttexts,failjj=result
+            if len(failjj)>0:
+                annoii.failed=True
+            faillist.extend(failjj)
 
             hlii.extend(hltexts)
             ntii.extend(nttexts)
@@ -1117,8 +1629,47 @@ def extractAnnos(annotations,action,verbose):
     return annotations2,faillist
 
 
+def iterDocBatches(db,docids,registry,ishighlight,isnote,size=BATCH_SIZE):
+    '''Get meta-data and annotations of docs, in batches
+
+    <docids>: list of ints, ids of docs.
+    <registry>: DocRegistry obj.
+    <size>: int, max number of docs in a batch.
+
+    Yield <docidsii>: list of ints, ids of docs in a batch.
+          <annotations>: dict, keys: docid, values: DocAnno objs, docs
+                         with annotations in the batch.
+          <otherdocs>: list, meta-data dicts of docs without annotations
+                       in the batch.
+    '''
+
+    for docidsii in _chunks(docids,size):
+
+        #----------Get meta data for docs----------
+        doc_meta=registry.getMetaData(db,docidsii)
+
+        #------------Get raw annotation data------------
+        annotations=registry.getAnnotations(db,docidsii,ishighlight,isnote)
+
+        if len(annotations)>0:
+            #----------Populate meta data for docs----------
+            for idii in annotations.keys():
+                annotations[idii]['meta']=doc_meta[idii]
+
+            #---------------Reformat annotations---------------
+            annotations=reformatAnno(annotations,\
+                    getFileHashes(db,annotations.keys()))
+
+        #------Get other docs without annotations------
+        otherdocs=[doc_meta[idii] for idii in docidsii if idii not in\
+                annotations]
+
+        yield docidsii,annotations,otherdocs
+
+
 def processDocs(db,outdir,docids,foldername,allfolders,action,\
-        separate,iszotero,verbose):
+        separate,iszotero,verbose,registry=None,pool=None,layoutcache=None,
+        copymethod='auto',journal=None,writer=None,hlmethod=None):
     '''Process files/docs.
 
     <db>: sqlite database.
@@ -1130,6 +1681,24 @@ def processDocs(db,outdir,docids,foldername,allfolders,action,\
     <separate>: bool, whether save one output for each file or all files.
     <iszotero>: bool, whether exported .bib is reformated to cater to zotero
                 import or not.
+    <registry>: DocRegistry obj or None, docs processed in previous folders.
+                If None, create a new one.
+    <pool>: multiprocessing.Pool or workers.IsolatedPool obj or None, pool
+            to extract annotations from files in parallel.
+    <layoutcache>: LayoutCache obj or None, cache of page layouts.
+    <copymethod>: str, how to copy un-annotated PDFs, see
+                  exportpdf.copyFile().
+
+    <journal>: Journal obj or None, to save a checkpoint after each batch.
+                If it has the state of <foldername> interrupted before,
+                skip the docs done.
+    <writer>: tools.OutputWriter obj or None, writer of .bib and .ris files.
+              Files in the folder of <foldername> are finished at the end.
+              If None, create one for the folder.
+    <hlmethod>: str or None, method to extract highlights, see
+                extracthl2.getMethod(). None for 'auto'.
+
+    Docs are processed in batches of BATCH_SIZE, see processBatch().
 
     Author: guangzhi XU (xugzhi1987@gmail.com; guangzhi.xu@outlook.com)
     Update time: 2018-08-06 21:42:27.
@@ -1147,44 +1716,130 @@ def processDocs(db,outdir,docids,foldername,allfolders,action,\
     if 'n' in action or 'p' in action:
         isnote=True
 
+    if registry is None:
+        registry=DocRegistry()
+    if writer is None:
+        writer=OutputWriter()
+
     #---------------Remove docs in trash---------------
-    docids=removeTrashedDocs(db,docids)
+    docids=removeTrashedDocs(db,docids,registry.getContext(db))
 
-    #----------Get meta data for docs----------
-    doc_meta={}
-    for idii in docids:
-        doc_meta[idii]=getMetaData(db,idii)
+    #--------Make subdir using folder name--------
+    outdir_folder=os.path.join(outdir,foldername)
+    if 'b' in action or 'p' in action or 'r' in action:
+        if not os.path.isdir(outdir_folder):
+            makedirs(outdir_folder)
+
+    numanno=0       # number of docs with annotations
+    annofile=None   # txt file to save annotations, if not <separate>
+    done=set()      # ids of docs done, for checkpoints
+    if journal is None:
+        tagspool=extracttags.TagSpool()
+    else:
+        tagspool=extracttags.TagSpool(os.path.join(outdir_folder,\
+                TAGS_SPOOL_DIR),journal.record)
+        state=journal.getState(foldername)
+        if state is not None:
+            done=set(state['done'])
+            numanno=state['numanno']
+            annofile=state['annofile']
+            tagspool.files=dict(state['tagfiles'])
+            donedocs=[idii for idii in docids if idii in done]
+            docids=[idii for idii in docids if idii not in done]
+            if verbose:
+                printHeader('Continue after %d docs done before.'\
+                        %len(donedocs),2)
+            registry.release(donedocs)
 
-    #------------Get raw annotation data------------
-    annotations={}
-    for idii in docids:
-        if ishighlight:
-            annotations = getHighlights(db,idii,annotations)
-        if isnote:
-            annotations = getNotes(db,idii,annotations)
-            annotations = getDocNotes(db,idii,annotations)
+    #------------Loop through batches of docs------------
+    # docs are fetched, extracted and exported in batches, outputs are
+    # appended after each batch, so memory use doesn't grow with the
+    # number of docs.
+    batches=iterDocBatches(db,docids,registry,ishighlight,isnote)
+    nbatch=(len(docids)+BATCH_SIZE-1)//BATCH_SIZE
 
-    if len(annotations)==0:
-        printHeader('No annotations found in folder: %s' %foldername,2)
-        # Need to add 'r', right?
-        if 'b' not in action and 'p' not in action and 'r' not in action:
-            return exportfaillist,annofaillist,bibfaillist,risfaillist
-    else:
-        #----------Populate meta data for docs----------
-        for idii in annotations.keys():
-            annotations[idii]['meta']=doc_meta[idii]
+    try:
+        for ii,(docidsii,annotations,otherdocs) in enumerate(batches):
+
+            numanno+=len(annotations)
+            if len(annotations)==0 and 'b' not in action and\
+                    'p' not in action and 'r' not in action:
+                registry.release(docidsii)
+                if journal is not None:
+                    done.update(docidsii)
+                    writer.flush()
+                    journal.checkpoint(foldername,done,numanno,annofile,\
+                            tagspool.files,registry,writer)
+                continue
+
+            if verbose and nbatch>1:
+                printNumHeader('Processing %d docs' %len(docidsii),ii+1,\
+                        nbatch,2)
+
+            if not os.path.isdir(outdir_folder):
+                makedirs(outdir_folder)
+
+            exportfaillistii,annofaillistii,bibfaillistii,risfaillistii,\
+                    annofile=processBatch(outdir,outdir_folder,annotations,\
+                    otherdocs,allfolders,action,separate,iszotero,verbose,\
+                    registry,pool,layoutcache,copymethod,annofile,tagspool,\
+                    writer,hlmethod)
 
-        #---------------Reformat annotations---------------
-        annotations=reformatAnno(annotations)
+            exportfaillist.extend(exportfaillistii)
+            annofaillist.extend(annofaillistii)
+            bibfaillist.extend(bibfaillistii)
+            risfaillist.extend(risfaillistii)
 
-    #------Get other docs without annotations------
-    otherdocs=[doc_meta[idii] for idii in docids if idii not in\
-            annotations.keys()]
+            registry.release(docidsii)
+            if journal is not None:
+                done.update(docidsii)
+                writer.flush()
+                journal.checkpoint(foldername,done,numanno,annofile,\
+                        tagspool.files,registry,writer)
+
+        if numanno==0:
+            printHeader('No annotations found in folder: %s' %foldername,2)
+        elif 'm' in action or 'n' in action:
+            #--------Export annotations grouped by tags--------
+            tagspool.export(outdir_folder,action,verbose,writer.record)
+
+        writer.close(outdir_folder)
+        if journal is not None:
+            journal.finishFolder(foldername,registry,writer)
+    finally:
+        # keep spooled annotations to resume an interrupted folder
+        if journal is None or journal.isDone(foldername):
+            tagspool.close()
 
-    #--------Make subdir using folder name--------
-    outdir_folder=os.path.join(outdir,foldername)
-    if not os.path.isdir(outdir_folder):
-        makedirs(outdir_folder)
+    return exportfaillist,annofaillist,bibfaillist,risfaillist
+
+
+def processBatch(outdir,outdir_folder,annotations,otherdocs,allfolders,\
+        action,separate,iszotero,verbose,registry,pool,layoutcache,\
+        copymethod,annofile,tagspool,writer,hlmethod=None):
+    '''Export a batch of docs in a folder.
+
+    <outdir_folder>: str, sub-folder under <outdir> to save outputs.
+    <annotations>: dict, keys: docid, values: DocAnno objs.
+    <otherdocs>: list, meta-data dicts of docs without annotations.
+    <annofile>: str or None, txt file to append annotations to, if not
+                <separate>. If None, get a new one if needed.
+    <tagspool>: extracttags.TagSpool obj, to collect annotations grouped
+                by tags.
+    <writer>: tools.OutputWriter obj, writer of .bib and .ris files, and
+              record of the other output files.
+
+    See processDocs() for other arguments.
+
+    Return <exportfaillist>, <annofaillist>, <bibfaillist>, <risfaillist>:
+           lists of failed files/docs.
+           <annofile>: str or None, txt file annotations are saved to.
+    '''
+
+    exportfaillist=[]
+    annofaillist=[]
+    bibfaillist=[]
+    risfaillist=[]
 
     #-------------------Export PDFs-------------------
     if 'p' in action:
@@ -1193,21 +1848,23 @@ def processDocs(db,outdir,docids,foldername,allfolders,action,\
             if verbose:
                 printHeader('Exporting annotated PDFs ...',2)
             flist=exportpdf.exportAnnoPdf(annotations,\
-                    outdir_folder,verbose)
+                    outdir_folder,verbose,registry.pdfs)
             exportfaillist.extend(flist)
     
         #--------Copy other PDFs to target location--------
         if len(otherdocs)>0:
             if verbose:
                 printHeader('Exporting un-annotated PDFs ...',2)
-            flist=exportpdf.copyPdf(otherdocs,outdir_folder,verbose)
+            flist=exportpdf.copyPdf(otherdocs,outdir_folder,verbose,\
+                    copymethod)
             exportfaillist.extend(flist)
 
     #----------Extract annotations from PDFs----------
     if len(annotations)>0:
         if verbose:
             printHeader('Extracting annotations from PDFs ...',2)
-        annotations,flist=extractAnnos(annotations,action,verbose)
+        annotations,flist=registry.extractAnnos(annotations,action,verbose,\
+                pool,layoutcache,hlmethod)
         annofaillist.extend(flist)
         # NOTE beyond this point things in <annotations> have changed:
         # key: docid as before. value: DocAnno as before, 
@@ -1218,13 +1875,19 @@ def processDocs(db,outdir,docids,foldername,allfolders,action,\
     if ('m' in action or 'n' in action) and len(annotations)>0:
         if verbose:
             printHeader('Exporting annotations to text file...',2)
+        if not separate and annofile is None:
+            annofile=exportannotation.getAnnoFile(outdir_folder,action,\
+                    verbose)
         flist=exportannotation.exportAnno(annotations,outdir_folder,action,\
-                separate,verbose)
+                separate,verbose,annofile,writer.record)
         annofaillist.extend(flist)
 
-        #--------Export annotations grouped by tags--------
-        tagsdict=extracttags.groupByTags(annotations)
-        extracttags.exportAnno(tagsdict,outdir_folder,action,verbose)
+        #--------Group annotations by tags--------
+        tagspool.add(extracttags.groupByTags(annotations))
+
+    # an IsolatedPool starts a process for each task, too costly to
+    # format entries
+    formatpool=None if isinstance(pool,workers.IsolatedPool) else pool
 
     #----------Export meta and anno to bib file----------
     if 'b' in action:
@@ -1242,13 +1905,15 @@ def processDocs(db,outdir,docids,foldername,allfolders,action,\
             # <bibfolder> is the folder to save .bib file, which is <outdir>
             # if <allfolders> is True, or <outdir>/<folder_tree> otherwise.
             flist=export2bib.exportAnno2Bib(annotations,outdir,\
-                bibfolder,allfolders,isfile,iszotero,iskeyword,verbose)
+                bibfolder,allfolders,isfile,iszotero,iskeyword,verbose,\
+                writer,formatpool)
             bibfaillist.extend(flist)
 
         #------Export other docs without annotations------
         if len(otherdocs)>0:
             flist=export2bib.exportDoc2Bib(otherdocs,outdir,\
-                bibfolder,allfolders,isfile,iszotero,iskeyword,verbose)
+                bibfolder,allfolders,isfile,iszotero,iskeyword,verbose,\
+                writer,formatpool)
             bibfaillist.extend(flist)
 
     #----------Export meta and anno to ris file----------
@@ -1267,17 +1932,18 @@ def processDocs(db,outdir,docids,foldername,allfolders,action,\
             # <bibfolder> is the folder to save .bib file, which is <outdir> if <allfolders> is True,
             # or <outdir>/<folder_tree> otherwise.
             flist=export2ris.exportAnno2Ris(annotations,outdir,\
-                risfolder,allfolders,isfile,iszotero,iskeyword,verbose)
+                risfolder,allfolders,isfile,iszotero,iskeyword,verbose,\
+                writer,formatpool)
             risfaillist.extend(flist)
 
         #------Export other docs without annotations------
         if len(otherdocs)>0:
             flist=export2ris.exportDoc2Ris(otherdocs,outdir,\
-                risfolder,allfolders,isfile,iszotero,iskeyword,verbose)
+                risfolder,allfolders,isfile,iszotero,iskeyword,verbose,\
+                writer,formatpool)
             risfaillist.extend(flist)
 
-
-    return exportfaillist,annofaillist,bibfaillist,risfaillist
+    return exportfaillist,annofaillist,bibfaillist,risfaillist,annofile
 
 
 def processCanonicals(db,outdir,annotations,docids,allfolders,action,\
@@ -1445,18 +2111,69 @@ def matchDOI(db):
 
 
 #----------------Main----------------
-def main(dbfin,outdir,action,folder,separate,iszotero,verbose=True):
+def loadManifest(outdir,options):
+    '''Load records of the previous export to <outdir>
+
+    <options>: tuple, options of the current export. Records of exports
+               using different options are not used.
+
+    Return <manifest>: dict or None, see saveManifest().
+    '''
 
+    abpath=os.path.join(outdir,MANIFEST_FILE)
     try:
-        db = sqlite3.connect(dbfin)
+        with open(abpath,'rb') as fin:
+            manifest=pickle.load(fin)
+    except:
+        return None
+
+    if manifest.get('options',None)!=options:
+        return None
+
+    return manifest
+
+
+def saveManifest(outdir,options,docs,outputs):
+    '''Save records of an export to <outdir>
+
+    <options>: tuple, options of the export.
+    <docs>: dict, keys: docid, values: records of docs, see
+            DocRegistry.getManifest().
+    <outputs>: list, paths of .txt, .bib and .ris files created.
+    '''
+
+    manifest={'options': options, 'docs': docs, 'outputs': outputs}
+    abpath=os.path.join(outdir,MANIFEST_FILE)
+    with open(abpath,'wb') as fout:
+        pickle.dump(manifest,fout,pickle.HIGHEST_PROTOCOL)
+
+
+def main(dbfin,outdir,action,folder,separate,iszotero,verbose=True,jobs=1,
+        cachedir=None,cachesize=layoutcache.DEFAULT_MAX_SIZE,
+        incremental=False,copymethod='auto',resume=False,filetimeout=None,
+        filemaxrss=None,dbmode='default',hlmethod='auto'):
+
+    try:
+        db = dbconn.connectDb(dbfin,dbmode)
         if verbose:
             printHeader('Connected to database:')
             printInd(dbfin,2)
+            if dbmode!='default':
+                printInd('(mode: %s)' %dbmode,2)
     except:
         printHeader('Failed to connect to database:')
         printInd(dbfin)
         return 1
 
+    _URL_PATHS.clear()
+
+    # snapshots are private copies, index them for the joins of the export
+    if dbconn.isMemory(db):
+        indexSnapshot(db,verbose)
+
+    # profiles don't change during the run, query them once
+    context=RunContext(db)
+
     #----------------Get folder list----------------
     folderlist=getFolderList(db,folder)
     if folder is not None and len(folderlist)==0:
@@ -1473,53 +2190,185 @@ def main(dbfin,outdir,action,folder,separate,iszotero,verbose=True):
         printHeader('It looks like no docs are found in the library. Quit.')
         return 1
 
+    #----------Get docids for docs in folders----------
+    folderdocs=[getFolderDocList(db,fidii) for fidii,fnameii in folderlist]
+
+    # number of folders each doc is in, to drop docs from registry after
+    # their last folder
+    uses={}
+    for docidsii in folderdocs:
+        for idjj in docidsii:
+            uses[idjj]=uses.get(idjj,0)+1
+    if folder is None:
+        for idjj in canonical_doc_ids:
+            uses[idjj]=uses.get(idjj,0)+1
+
     #---------------Process--------------------------
     exportfaillist=[]
     annofaillist=[]
     bibfaillist=[]
     risfaillist=[]
 
-    #---------------Loop through folders---------------
-    if len(folderlist)>0:
-        for ii,folderii in enumerate(folderlist):
-            fidii,fnameii=folderii
+    #--------Method to extract highlights--------
+    if 'm' in action:
+        method=extracthl2.getMethod(hlmethod)
+        if hlmethod!='auto' and method!=hlmethod:
+            printHeader('Method "%s" is not available. Extract highlights using %s.'\
+                    %(hlmethod,method))
+    else:
+        method=None
+
+    options=(__version__,sorted(action),folder,separate,iszotero,method)
+
+    #-------------Checkpoints to resume export-------------
+    journal=None
+    resumed=False
+    if resume:
+        journal=Journal(outdir,options+(dbfin,incremental))
+        resumed=journal.load()
+        if verbose:
+            if resumed:
+                printHeader('Resume the interrupted export from the last checkpoint.')
+            else:
+                printHeader('No interrupted export with the same options found in <outdir>. Export all docs.')
+
+    #----------------Incremental export----------------
+    if incremental:
+        manifest=loadManifest(outdir,options)
+
+        if manifest is None:
+            if verbose:
+                printHeader('No previous export with the same options found in <outdir>. Export all docs.')
+            manifest={'docs': {}, 'outputs': []}
+        else:
+            if verbose:
+                printHeader('Only process docs changed since the previous export.')
+            # .txt, .bib and .ris outputs are re-created, those of an
+            # interrupted export are already removed
+            if not resumed:
+                for pii in manifest['outputs']:
+                    if os.path.isfile(pii):
+                        os.remove(pii)
+
+        registry=DocRegistry(manifest['docs'],uses,context)
+    else:
+        # docs filed in multiple folders are only processed once
+        registry=DocRegistry(uses=uses,context=context)
+
+    # .bib and .ris files are written to tmp files, moved into place at the
+    # end. tmp files of the interrupted export are continued.
+    if journal is None:
+        writer=OutputWriter()
+    else:
+        writer=OutputWriter(resumed,log=journal.record)
+
+    if resumed:
+        registry.texts.update(journal.texts)
+        registry.pdfs.update(journal.pdfs)
+        writer.outputs.update(journal.outputs)
+    elif journal is not None:
+        journal.start()
+        journal.save(registry,writer)
+
+    #--------Pool to extract annotations from files--------
+    if (filetimeout is not None or filemaxrss is not None) and\
+            ('m' in action or 'n' in action):
+        if verbose:
+            printHeader('Extract annotations of each file in a new process.')
+        if filemaxrss is not None:
+            if workers.getRss(os.getpid()) is None:
+                printHeader('Memory use of processes is not available on this system. Ignore --file-max-rss.')
+                filemaxrss=None
+            else:
+                filemaxrss=int(filemaxrss*1024**2)
+        pool=workers.IsolatedPool(jobs,filetimeout,filemaxrss)
+    elif jobs is not None and jobs>1 and ('m' in action or 'n' in action or\
+            'b' in action or 'r' in action):
+        if verbose:
+            printHeader('Extract annotations and format .bib/.ris entries using %d processes.' %jobs)
+        pool=multiprocessing.Pool(jobs)
+    else:
+        pool=None
+
+    try:
+        #--------------Cache of page layouts--------------
+        if cachedir is not None and 'm' in action:
             if verbose:
-                printNumHeader('Processing folder: "%s"' %fnameii,\
-                        ii+1,len(folderlist),1)
+                printHeader('Use page layout cache in:')
+                printInd(cachedir,2)
+            cache=layoutcache.LayoutCache(cachedir,cachesize)
+        else:
+            cache=None
 
-            #----------Get docids for docs in folder----------
-            docidsii=getFolderDocList(db,fidii)
+        #---------------Loop through folders---------------
+        if len(folderlist)>0:
+            for ii,folderii in enumerate(folderlist):
+                fidii,fnameii=folderii
+                if verbose:
+                    printNumHeader('Processing folder: "%s"' %fnameii,\
+                            ii+1,len(folderlist),1)
+
+                docidsii=folderdocs[ii]
+
+                if journal is not None and journal.isDone(fnameii):
+                    if verbose:
+                        printHeader('Folder done before, skip.',2)
+                    registry.release(docidsii)
+                    continue
+
+                exportfaillistii,annofaillistii,bibfaillistii,risfaillistii=\
+                    processDocs(db,outdir,docidsii,fnameii,allfolders,action,
+                    separate,iszotero,verbose,registry,pool,cache,copymethod,
+                    journal,writer,method)
+
+                exportfaillist.extend(exportfaillistii)
+                annofaillist.extend(annofaillistii)
+                bibfaillist.extend(bibfaillistii)
+                risfaillist.extend(risfaillistii)
+
+        #---------------Process canonical docs ------------
+        if folder is None and len(canonical_doc_ids)>0 and\
+                not (journal is not None and journal.isDone('My Library')):
+            if verbose:
+                printHeader('Processing docs under "My Library"')
 
             exportfaillistii,annofaillistii,bibfaillistii,risfaillistii=\
-                processDocs(db,outdir,docidsii,fnameii,allfolders,action,
-                separate,iszotero,verbose)
+                    processDocs(db,outdir,canonical_doc_ids,'My Library',
+                        allfolders,action,separate,iszotero,verbose,registry,\
+                        pool,cache,copymethod,journal,writer,method)
 
             exportfaillist.extend(exportfaillistii)
             annofaillist.extend(annofaillistii)
             bibfaillist.extend(bibfaillistii)
             risfaillist.extend(risfaillistii)
 
-    #---------------Process canonical docs ------------
-    if folder is None and len(canonical_doc_ids)>0:
-        if verbose:
-            printHeader('Processing docs under "My Library"')
-
-        exportfaillistii,annofaillistii,bibfaillistii,risfaillistii=\
-                processDocs(db,outdir,canonical_doc_ids,'My Library',
-                    allfolders,action,separate,iszotero,verbose)
-
-        exportfaillist.extend(exportfaillistii)
-        annofaillist.extend(annofaillistii)
-        bibfaillist.extend(bibfaillistii)
-        risfaillist.extend(risfaillistii)
-
-        printHeader('NOTE that docs not belonging to any folder is saved to directory : "Canonical-My Library"')
+            printHeader('NOTE that docs not belonging to any folder is saved to directory : "Canonical-My Library"')
+    except:
+        # don't leave workers running
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
 
     #-----------------Close connection-----------------
     if verbose:
         printHeader('Drop connection to database:')
     db.close()
 
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # move .bib and .ris files into place
+    writer.close()
+
+    if incremental:
+        saveManifest(outdir,options,registry.getManifest(),\
+                list(writer.outputs))
+
+    if journal is not None:
+        journal.remove()
+
     #------------------Print summary------------------
     exportfaillist=list(set(exportfaillist))
     annofaillist=list(set(annofaillist))
@@ -1655,6 +2504,86 @@ if __name__ == "__main__":
             Default is False.
             ''')
 
+    parser.add_argument('-j', '--jobs', dest='jobs',\
+            type=int, default=1,\
+            help='''Number of processes to extract highlights and notes
+            from PDFs, and format .bib and .ris entries, in parallel.
+            Default to 1.''')
+
+    parser.add_argument('--hl-method', dest='hlmethod',\
+            type=str, default='auto', choices=['auto']+extracthl2.METHODS,\
+            help='''How to extract texts of highlights. "pdftotext": use
+            the pdftotext tool. "pdfminer": use pdfminer. "numpy": use
+            pdfminer, and match characters to highlights with numpy, faster
+            on pages with many highlights, needs numpy. "auto": "pdftotext"
+            if available, "pdfminer" otherwise. Unavailable methods fall
+            back to "pdfminer". Default to "auto".''')
+
+    parser.add_argument('--layout-cache', dest='cachedir',\
+            type=str, default=None,\
+            help='''Folder to cache page layouts of PDFs. Pages already
+            analyzed in previous runs are read from the cache, which
+            speeds up highlight extraction. Default to no cache.''')
+
+    parser.add_argument('--layout-cache-size', dest='cachesize',\
+            type=float, default=layoutcache.DEFAULT_MAX_SIZE,\
+            help='''Max size of the page layout cache folder, in Mb.
+            Least recently used pages are removed if exceeded. Shared by
+            all processes of -j, each checks the size of the folder after
+            writing 1/10 of this. Default to %d.''' %layoutcache.DEFAULT_MAX_SIZE)
+
+    parser.add_argument('-i', '--incremental', action='store_true',\
+            default=False,\
+            help='''Only process docs changed since the previous export
+            to the same <outdir> with the same options. Highlights and
+            notes of other docs are taken from the previous export, and
+            .txt, .bib and .ris files are re-created.''')
+
+    parser.add_argument('--file-timeout', dest='filetimeout',\
+            type=float, default=None,\
+            help='''Max time in seconds to extract annotations from a
+            single PDF. If given, each PDF is processed in a new process,
+            which is killed after this time, and the PDF is reported as
+            failed. Default to no limit.''')
+
+    parser.add_argument('--file-max-rss', dest='filemaxrss',\
+            type=float, default=None,\
+            help='''Max memory in Mb to extract annotations from a single
+            PDF. If given, each PDF is processed in a new process, which
+            is killed if its resident memory gets larger than this, and the
+            PDF is reported as failed. The limit is per process, memory
+            shared with the main process is not counted. Only on systems
+            with /proc (Linux). Default to no limit.''')
+
+    parser.add_argument('--db-mode', dest='dbmode',\
+            type=str, default='default', choices=dbconn.DB_MODES,\
+            help='''How to open the Mendeley database. "default": a normal
+            connection. "readonly": read-only and immutable, no locks are
+            taken, don't use if Mendeley is running and changing the
+            library. "snapshot": copy the database into memory first, then
+            query the copy, safe to use while Mendeley is running. The copy
+            is indexed for the lookups of the export.
+            Default to "default".''')
+
+    parser.add_argument('--resume', action='store_true',\
+            default=False,\
+            help='''Save a checkpoint to <outdir> after each batch of docs,
+            and resume an export to <outdir> interrupted before, if it was
+            also run with --resume and the same options. Folders and docs
+            done before are skipped, and files written after the last
+            checkpoint are rolled back.''')
+
+    parser.add_argument('--copy-method', dest='copymethod',\
+            type=str, default='auto', choices=exportpdf.COPY_METHODS,\
+            help='''How to copy PDFs without annotations to <outdir>
+            when using -p. "hardlink": hard link to the Mendeley file,
+            note that changes to either will change both. "reflink":
+            copy-on-write clone, on file systems supporting it (btrfs, xfs).
+            "symlink": symbolic link to the Mendeley file. "copy": copy
+            the data. "auto": try "reflink", then "copy". Default to "auto".
+            Files already copied with the same size and modification
+            time are skipped.''')
+
     parser.add_argument('-v', '--verbose', action='store_true',\
             default=True,\
             help='Print some texts.')
@@ -1669,7 +2598,10 @@ if __name__ == "__main__":
     outdir = os.path.abspath(args.outdir)
 
     main(dbfile,outdir,args.action,args.folder,\
-            args.separate,args.zotero,args.verbose)
+            args.separate,args.zotero,args.verbose,args.jobs,\
+            args.cachedir,args.cachesize,args.incremental,args.copymethod,
+            args.resume,args.filetimeout,args.filemaxrss,args.dbmode,
+            args.hlmethod)
 
 
 